@@ -20,7 +20,7 @@ from sqlalchemy.util._collections import NamedTuple
 __session__ = DBSession
 __metadata__ = metadata
 
-__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'Access', 'AccessPrivilege']
+__all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'JobStage', 'Access', 'AccessPrivilege']
 __all__ += ['ResearchGroup', 'Person', 'Subject', 'DataContainer', 'Experiment', 'Session', 'Epoch', 'Dataset']
 
 
@@ -296,10 +296,17 @@ class Job(Entity):
     status = Field(Enum(u'pending', u'running', u'done', u'failed', u'abandoned', 'rerun', name=u'job_status'))
     task = Field(Enum(u'find', u'proc', u'find&proc', name=u'job_task'))
     needs_rerun = Field(Boolean, default=False)
+    priority = Field(Integer, default=0)            # higher priority jobs are processed first
+    notbefore = Field(DateTime)                     # pending jobs are not claimed before this time
+    queued = Field(DateTime, default=datetime.datetime.now)     # last (re)queued as pending, jobs age from then
     progress = Field(Integer)
     activity = Field(Unicode(255))
+    owner = Field(Unicode(255))                     # processor holding the lease, as hostname:pid
+    heartbeat = Field(DateTime)
+    lease_expiry = Field(DateTime, index=True)
 
     data_container = ManyToOne('DataContainer', inverse='jobs')
+    stages = OneToMany('JobStage')
 
     def __repr__(self):
         return ('<Job %d: %s, %s>' % (self.id, self.task, self.status)).encode('utf-8')
@@ -308,6 +315,22 @@ class Job(Entity):
         return u'%s %s' % (self.data_container, self.task)
 
 
+class JobStage(Entity):
+
+    """Time spent, and bytes written, in one stage of a Job's pipeline."""
+
+    stage = Field(Unicode(31), index=True)
+    started = Field(DateTime, index=True)
+    wall_time = Field(Float)
+    cpu_time = Field(Float)
+    bytes_written = Field(BigInteger)
+
+    job = ManyToOne('Job', inverse='stages')
+
+    def __repr__(self):
+        return ('<JobStage %s: %.1fs>' % (self.stage, self.wall_time)).encode('utf-8')
+
+
 class AccessPrivilege(object):
 
     privilege_names = {
@@ -811,7 +834,10 @@ class Dataset(Entity):
     datatype = Field(Enum(u'unknown', u'mr_fmri', u'mr_dwi', u'mr_structural', u'mr_fieldmap', u'mr_spectro', name=u'dataset_datatype'), default=u'unknown')
     _updatetime = Field(DateTime, default=datetime.datetime.now, colname='updatetime', synonym='updatetime')
     digest = Field(LargeBinary(20))
+    manifest = Field(Unicode, deferred=True)    # JSON of the size, mtime, inode and sha1 of each file, see nimsutil.update_manifest
+    member_digests = Field(Unicode, deferred=True)  # JSON of the size and mtime of each archive member appended by the sorter, see nimsutil.append_archive
     compressed = Field(Boolean, default=False)
+    complete = Field(Boolean, default=False)        # all files of the series have been sorted, no need to wait for more
     archived = Field(Boolean, default=False, index=True)
     _filenames = Field(String, default='', colname='filenames', synonym='filenames')
 
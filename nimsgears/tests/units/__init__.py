@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Unit test suite for the processing daemons and their utilities."""
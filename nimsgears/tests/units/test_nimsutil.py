@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the notifiers, manifests and archive helpers of nimsutil."""
+import os
+import gzip
+import time
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import cStringIO
+
+from nose.tools import eq_, ok_
+
+import nimsutil
+
+
+def write_file(path, data, mtime=None):
+    with open(path, 'wb') as fd:
+        fd.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def write_archive(tgz_path, files):
+    """Write a gzipped tar archive of a directory holding files, a dictionary of names and (data, mtime)."""
+    src_dir = tempfile.mkdtemp()
+    try:
+        series_dir = os.path.join(src_dir, 'series')
+        os.mkdir(series_dir)
+        for name, (data, mtime) in files.iteritems():
+            write_file(os.path.join(series_dir, name), data, mtime)
+        with tarfile.open(tgz_path, 'w:gz') as archive:
+            archive.add(series_dir, 'series')
+    finally:
+        shutil.rmtree(src_dir)
+
+
+class TestSocketNotifier(object):
+    """Unit test case for ``SocketNotifier``."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.notifier = nimsutil.SocketNotifier(self.path, 'nims_job')
+
+    def tearDown(self):
+        self.notifier.close()
+        shutil.rmtree(self.path)
+
+    def test_notify_wakes_listener(self):
+        """A notification is received by the listener of its channel"""
+        nimsutil.SocketNotifier(self.path).notify('nims_job', 'hello')
+        eq_(self.notifier.wait(1), [('nims_job', 'hello')])
+
+    def test_wait_times_out(self):
+        """Waiting without notifications returns nothing after the timeout"""
+        start = time.time()
+        eq_(self.notifier.wait(0.1), [])
+        ok_(time.time() - start >= 0.1)
+
+    def test_notify_without_listener(self):
+        """Notifications to a channel without a listener are dropped"""
+        self.notifier.notify('nims_sort', 'hello')
+        eq_(self.notifier.wait(0.1), [])
+
+    def test_watch(self):
+        """Files written into a watched directory wake up the listener, if they match its patterns"""
+        watch_path = os.path.join(self.path, 'data')
+        os.mkdir(watch_path)
+        self.notifier.watch(watch_path, ['P?????.7'])
+        if not self.notifier.watchers:
+            return  # inotify not supported on this platform
+        write_file(os.path.join(watch_path, 'P00001.7.aux'), 'aux')
+        write_file(os.path.join(watch_path, 'P00001.7'), 'pfile')
+        eq_(self.notifier.wait(1), [(watch_path, 'P00001.7')])
+
+
+class TestManifest(object):
+    """Unit test case for ``update_manifest`` and ``manifest_digest``."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        write_file(os.path.join(self.path, 'a.dcm'), 'a' * 1000, 1000000000)
+        write_file(os.path.join(self.path, 'b.dcm'), 'b' * 1000, 1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_entries(self):
+        """The manifest lists the sha1 of each file"""
+        manifest = nimsutil.update_manifest(self.path)
+        eq_(sorted(manifest), ['a.dcm', 'b.dcm'])
+        eq_(manifest['a.dcm']['sha1'], hashlib.sha1('a' * 1000).hexdigest())
+        eq_(manifest['a.dcm']['size'], 1000)
+
+    def test_unchanged_files_not_rehashed(self):
+        """Only new or changed files are hashed again"""
+        manifest = nimsutil.update_manifest(self.path)
+        manifest['a.dcm']['sha1'] = 'stale'
+        write_file(os.path.join(self.path, 'b.dcm'), 'c' * 2000)
+        manifest = nimsutil.update_manifest(self.path, manifest)
+        eq_(manifest['a.dcm']['sha1'], 'stale')
+        eq_(manifest['b.dcm']['sha1'], hashlib.sha1('c' * 2000).hexdigest())
+
+    def test_digest_stable_across_archiving(self):
+        """Archiving the files does not change the digest of the manifest"""
+        digest = nimsutil.manifest_digest(nimsutil.update_manifest(self.path))
+        archive_path = tempfile.mkdtemp()
+        try:
+            series_path = os.path.join(archive_path, 'series')
+            shutil.copytree(self.path, series_path)
+            nimsutil.tar_directory(series_path, os.path.join(archive_path, 'series.tgz'))
+            shutil.rmtree(series_path)
+            eq_(nimsutil.manifest_digest(nimsutil.update_manifest(archive_path)), digest)
+        finally:
+            shutil.rmtree(archive_path)
+
+    def test_digest_changes_with_contents(self):
+        """Changing a file changes the digest of the manifest"""
+        digest = nimsutil.manifest_digest(nimsutil.update_manifest(self.path))
+        write_file(os.path.join(self.path, 'b.dcm'), 'c' * 1000)
+        ok_(nimsutil.manifest_digest(nimsutil.update_manifest(self.path)) != digest)
+
+
+class TestGzipParallel(object):
+    """Unit test case for ``gzip_parallel``."""
+
+    def compress(self, data, **kwargs):
+        dst = cStringIO.StringIO()
+        nimsutil.gzip_parallel(cStringIO.StringIO(data), dst, **kwargs)
+        return dst.getvalue()
+
+    def decompress(self, data):
+        return gzip.GzipFile(fileobj=cStringIO.StringIO(data)).read()
+
+    def test_roundtrip(self):
+        """Blocks compressed in parallel decompress into the input"""
+        data = os.urandom(5000) + 'x' * 50000 + os.urandom(3000)
+        eq_(self.decompress(self.compress(data, threads=3, block_size=4096)), data)
+
+    def test_single_block(self):
+        """Input smaller than a block decompresses into the input"""
+        eq_(self.decompress(self.compress('nims' * 10)), 'nims' * 10)
+
+    def test_empty(self):
+        """Empty input gives a valid, empty gzip stream"""
+        eq_(self.decompress(self.compress('')), '')
+
+    def test_header(self):
+        """The filename and mtime are stored in the gzip header"""
+        data = self.compress('nims', filename='P00001.7', mtime=1000000000)
+        eq_(data[10:19], 'P00001.7\x00')
+        archive = gzip.GzipFile(fileobj=cStringIO.StringIO(data))
+        archive.read()
+        eq_(archive.mtime, 1000000000)
+
+
+class TestAppendArchive(object):
+    """Unit test case for ``append_archive`` and ``extract_heads``."""
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_path, 'dataset')
+        os.mkdir(self.path)
+        self.tgz_path = os.path.join(self.temp_path, 'series.tgz')
+        write_archive(self.tgz_path, {'P00001.7': ('p' * 100000, 1000000000), 'P00001.7.aux': ('aux', 1000000000)})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def test_append(self):
+        """Members are stored as files, gzipped if they match gzip_patterns, and listed in DIGEST.txt"""
+        digests, manifest = nimsutil.append_archive(self.tgz_path, self.path)
+        eq_(sorted(os.listdir(self.path)), ['DIGEST.txt', 'P00001.7.aux', 'P00001.7.gz'])
+        eq_(gzip.open(os.path.join(self.path, 'P00001.7.gz')).read(), 'p' * 100000)
+        eq_(open(os.path.join(self.path, 'DIGEST.txt')).read().split(), ['DIGEST.txt', 'P00001.7.aux', 'P00001.7.gz'])
+        eq_(digests['P00001.7.gz'], [100000, 1000000000])
+        eq_(os.path.getmtime(os.path.join(self.path, 'P00001.7.gz')), 1000000000)
+
+    def test_manifest_matches_update_manifest(self):
+        """The manifest of the written files is that update_manifest would compute"""
+        digests, manifest = nimsutil.append_archive(self.tgz_path, self.path)
+        eq_(manifest, nimsutil.update_manifest(self.path))
+
+    def test_resend_skipped(self):
+        """Members appended before, and unchanged, are not written again"""
+        digests, manifest = nimsutil.append_archive(self.tgz_path, self.path)
+        inode = os.stat(os.path.join(self.path, 'P00001.7.gz')).st_ino
+        digests, manifest = nimsutil.append_archive(self.tgz_path, self.path, digests, manifest)
+        eq_(os.stat(os.path.join(self.path, 'P00001.7.gz')).st_ino, inode)
+        eq_(manifest, nimsutil.update_manifest(self.path))
+
+    def test_append_another(self):
+        """Appending another archive keeps the files appended before"""
+        digests, manifest = nimsutil.append_archive(self.tgz_path, self.path)
+        other_tgz_path = os.path.join(self.temp_path, 'other.tgz')
+        write_archive(other_tgz_path, {'P00002.7': ('q' * 1000, 1000000000)})
+        digests, manifest = nimsutil.append_archive(other_tgz_path, self.path, digests, manifest)
+        eq_(sorted(digests), ['P00001.7.aux', 'P00001.7.gz', 'P00002.7.gz'])
+        eq_(open(os.path.join(self.path, 'DIGEST.txt')).read().split(), ['DIGEST.txt', 'P00001.7.aux', 'P00001.7.gz', 'P00002.7.gz'])
+        eq_(manifest, nimsutil.update_manifest(self.path))
+
+    def test_extract_heads(self):
+        """Only the first nbytes of the members matching each pattern are extracted"""
+        heads = nimsutil.extract_heads(self.tgz_path, self.path, ['P?????.7', '*.dcm'], 1000)
+        eq_(heads, {'P?????.7': os.path.join(self.path, 'P00001.7')})
+        eq_(open(heads['P?????.7']).read(), 'p' * 1000)
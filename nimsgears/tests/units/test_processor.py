@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Test suite for the job ranking and memory admission of the processor."""
+import os
+import sys
+import datetime
+
+from nose.tools import eq_, ok_
+
+from nimsgears.model import *
+from nimsgears.tests import setup_db, teardown_db
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, 'nimsproc'))
+import processor
+
+
+def setup():
+    """Function called by nose on module load"""
+    setup_db()
+
+def teardown():
+    """Function called by nose after all tests in this module ran"""
+    teardown_db()
+
+
+class TestEstimateMemory(object):
+    """Unit test case for ``estimate_memory``."""
+
+    def test_pfile(self):
+        """PFile recons hold the k-space of every receiver, and the image, twice"""
+        eq_(processor.estimate_memory(u'pfile', 64, 64, 10, 100, 1, 32), 2 * 8 * 64*64*10*100 * 32 + 2 * 4 * 64*64*10*100)
+
+    def test_mux_bands(self):
+        """Multiband pfiles acquire, and hold the k-space of, fewer slices"""
+        eq_(processor.estimate_memory(u'pfile', 64, 64, 12, 100, 3, 32), 2 * 8 * 64*64*4*100 * 32 + 2 * 4 * 64*64*12*100)
+
+    def test_dicom(self):
+        """Dicom conversion only holds a few copies of the image"""
+        eq_(processor.estimate_memory(u'dicom', 256, 256, 100, 1, None, None), 3 * 4 * 256*256*100)
+
+    def test_unknown_dimensions(self):
+        """Unknown dimensions fall back to those of a small scan"""
+        eq_(processor.estimate_memory(None, None, None, None, None, None, None), 3 * 4 * 64*64)
+
+
+class TestScheduling(object):
+    """Unit test case for ``Processor.rank`` and ``Processor.admit``."""
+
+    def setUp(self):
+        self.processor = object.__new__(processor.Processor)
+        self.processor.task = None
+        self.processor.filters = []
+        self.processor.fairshare = 'experiment'
+        self.processor.aging = 1.0
+        self.processor.newest = False
+        self.processor.memory_budget = None
+        self.processor.reservations = {}
+        self.group = ResearchGroup(gid=u'test')
+        self.experiments = [Experiment(name=u'one', owner=self.group), Experiment(name=u'two', owner=self.group)]
+        self.now = datetime.datetime.now()
+
+    def tearDown(self):
+        DBSession.rollback()
+
+    def add_job(self, experiment, priority=0, hours_waited=0, status=u'pending', filetype=u'dicom', size=(64, 64, 1, 1)):
+        """Add a job on a new epoch of experiment, returning its id."""
+        session = Session(subject=Subject(experiment=experiment))
+        epoch = Epoch(session=session, size_x=size[0], size_y=size[1], num_slices=size[2], num_timepoints=size[3])
+        Dataset(container=epoch, kind=u'primary', filetype=filetype)
+        job = Job(data_container=epoch, task=u'find&proc', status=status, priority=priority, queued=self.now - datetime.timedelta(hours=hours_waited))
+        DBSession.flush()
+        return job.id
+
+    def test_rank_by_priority(self):
+        """Jobs of higher priority rank first, ties go to the oldest job"""
+        low = self.add_job(self.experiments[0])
+        high = self.add_job(self.experiments[1], priority=10)
+        tie = self.add_job(self.experiments[0], priority=0)
+        eq_(self.processor.rank(self.processor.pending_query(), 10), [high, low, tie])
+
+    def test_rank_aging(self):
+        """Jobs gain priority as they wait"""
+        live = self.add_job(self.experiments[0], priority=5)
+        backfill = self.add_job(self.experiments[1], hours_waited=10)
+        eq_(self.processor.rank(self.processor.pending_query(), 10), [backfill, live])
+
+    def test_rank_fairshare(self):
+        """Jobs of an experiment with jobs running, or ranked ahead, rank after those of other experiments"""
+        self.add_job(self.experiments[0], status=u'running')
+        busy = self.add_job(self.experiments[0])
+        idle = self.add_job(self.experiments[1])
+        eq_(self.processor.rank(self.processor.pending_query(), 10), [idle, busy])
+
+    def test_rank_limit(self):
+        """At most limit jobs are ranked"""
+        for i in range(3):
+            self.add_job(self.experiments[0])
+        eq_(len(self.processor.rank(self.processor.pending_query(), 2)), 2)
+
+    def test_admit_within_budget(self):
+        """Jobs are admitted in rank order, while they fit into the memory budget"""
+        small = self.add_job(self.experiments[0])
+        large = self.add_job(self.experiments[0], size=(256, 256, 100, 1))
+        self.processor.memory_budget = processor.estimate_memory(u'dicom', 256, 256, 100, 1, None, None)
+        admitted = self.processor.admit(self.processor.pending_query(), [large, small], 10)
+        eq_(admitted, {large: self.processor.memory_budget})
+
+    def test_admit_reserves_for_waiting_job(self):
+        """A job that does not fit reserves its memory, and jobs behind it only get what is left over"""
+        large = self.add_job(self.experiments[0], size=(256, 256, 100, 1))
+        small = self.add_job(self.experiments[0])
+        self.processor.memory_budget = processor.estimate_memory(u'dicom', 256, 256, 100, 1, None, None) + processor.estimate_memory(u'dicom', 64, 64, 1, 1, None, None)
+        self.processor.reservations = {0: processor.estimate_memory(u'dicom', 256, 256, 50, 1, None, None)}
+        admitted = self.processor.admit(self.processor.pending_query(), [large, small], 10)
+        eq_(admitted, {})
+
+    def test_admit_oversized_when_idle(self):
+        """A job larger than the whole budget is admitted when nothing else is running"""
+        large = self.add_job(self.experiments[0], filetype=u'pfile', size=(128, 128, 60, 500))
+        self.processor.memory_budget = 2**30
+        admitted = self.processor.admit(self.processor.pending_query(), [large], 10)
+        eq_(admitted.keys(), [large])
+        ok_(admitted[large] > self.processor.memory_budget)
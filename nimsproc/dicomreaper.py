@@ -22,7 +22,7 @@ log = logging.getLogger('dicomreaper')
 
 class DicomReaper(object):
 
-    def __init__(self, id_, scu, pat_id, discard_ids, reap_path, sort_path, datetime_file, sleep_time):
+    def __init__(self, id_, scu, pat_id, discard_ids, reap_path, sort_path, datetime_file, sleep_time, notifier=None):
         self.id_ = id_
         self.scu = scu
         self.pat_id = pat_id
@@ -31,6 +31,7 @@ class DicomReaper(object):
         self.sort_stage = nimsutil.make_joined_path(sort_path)
         self.datetime_file = datetime_file
         self.sleep_time = sleep_time
+        self.notifier = notifier or nimsutil.Notifier()
 
         self.current_exam_datetime = nimsutil.get_reference_datetime(self.datetime_file)
         self.monitored_exams = collections.deque()
@@ -154,8 +155,10 @@ class Series(object):
             reap_count = self.reaper.scu.move(scu.SeriesQuery(SeriesInstanceUID=self.uid), reap_path)
             if reap_count == self.image_count:
                 self.tar_into_acquisitions(reap_path)
+                nimsutil.write_complete_marker(reap_path, os.listdir(reap_path))
                 shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
                 os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
+                self.reaper.notifier.notify('nims_stage')
                 self.needs_reaping = False
                 log.info('Reaped      %s' % self)
             else:
@@ -192,6 +195,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-d', '--discard', default='discard', help='space-separated list of Patient IDs to discard')
         self.add_argument('-p', '--patid', help='glob for Patient IDs to reap (default: "*")')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-N', '--notify', help='postgresql URI or socket directory to notify of staged data')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -205,7 +209,8 @@ if __name__ == '__main__':
     scu_ = scu.SCU(host, port, return_port, args.aet, args.aec)
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % args.aec)
 
-    reaper = DicomReaper(args.aec, scu_, args.patid, args.discard.split(), args.reap_path, args.sort_path, datetime_file, args.sleeptime)
+    notifier = nimsutil.Notifier.from_uri(args.notify)
+    reaper = DicomReaper(args.aec, scu_, args.patid, args.discard.split(), args.reap_path, args.sort_path, datetime_file, args.sleeptime, notifier)
 
     def term_handler(signum, stack):
         reaper.halt()
@@ -20,16 +20,21 @@ log = logging.getLogger('pfilereaper')
 
 class PFileReaper(object):
 
-    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, sleep_time):
+    settle_time = 5     # seconds a pfile reported closed, and its aux files, must be left alone before it is reaped
+
+    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, sleep_time, notifier=None):
         super(PFileReaper, self).__init__()
         self.id_ = id_
         self.pat_id = pat_id
         self.discard_ids = discard_ids
+        self.data_path = data_path
         self.data_glob = os.path.join(data_path, 'P?????.7')
         self.reap_stage = nimsutil.make_joined_path(reap_path)
         self.sort_stage = nimsutil.make_joined_path(sort_path)
         self.datetime_file = datetime_file
         self.sleep_time = sleep_time
+        self.notifier = notifier or nimsutil.Notifier()
+        self.notifier.watch(data_path, ['P?????.7'])
 
         self.current_file_timestamp = nimsutil.get_reference_datetime(self.datetime_file)
         self.monitored_files = {}
@@ -47,9 +52,12 @@ class PFileReaper(object):
         self.alive = False
 
     def run(self):
+        settling = {}   # path of each pfile reported closed, and when to reap it, if it has not changed by then
+        due_paths = []
         while self.alive:
             try:
-                reap_files = [ReapPFile(p, self) for p in glob.glob(self.data_glob)]
+                # between timeouts, only look at the files reported closed, instead of scanning data_path
+                reap_files = [ReapPFile(p, self) for p in (due_paths or glob.glob(self.data_glob)) if os.path.exists(p)]
                 if not reap_files:
                     raise Warning('No matching files found (or error while checking for files)')
             except (OSError, Warning) as e:
@@ -60,19 +68,54 @@ class PFileReaper(object):
                     if rf.path in self.monitored_files:
                         mf = self.monitored_files[rf.path]
                         if mf.needs_reaping and rf.size == mf.size:
-                            rf.reap()
-                            if not rf.needs_reaping:
-                                nimsutil.update_reference_datetime(self.datetime_file, rf.mod_time)
-                                self.current_file_timestamp = rf.mod_time
+                            self.reap(rf)
                         elif mf.needs_reaping:
                             log.info('Monitoring  %s' % rf)
                         elif rf.size == mf.size:
                             rf.needs_reaping = False
                     else:
                         log.info('Discovered  %s' % rf)
-                self.monitored_files = dict(zip([rf.path for rf in reap_files], reap_files))
+                if due_paths:
+                    self.monitored_files.update((rf.path, rf) for rf in reap_files)
+                else:
+                    self.monitored_files = dict(zip([rf.path for rf in reap_files], reap_files))
             finally:
-                time.sleep(self.sleep_time)
+                due_paths = self.wait_for_closed(settling)
+
+    def wait_for_closed(self, settling):
+        """
+        Wait up to sleep_time for pfiles reported closed to settle, returning their paths, or [] on timeout.
+
+        A pfile reported closed is monitored from then on, and is reaped once its size has not changed
+        for settle_time, rather than a whole sleep_time, giving the scanner time to write its aux files.
+        """
+        deadline = time.time() + self.sleep_time
+        while self.alive:
+            now = time.time()
+            due_paths = [p for p, t in settling.iteritems() if t <= now]
+            if due_paths or now >= deadline:
+                for p in due_paths:
+                    del settling[p]
+                return due_paths
+            for path, fn in self.notifier.wait(min([deadline] + settling.values()) - now):
+                filepath = os.path.join(path, fn)
+                if path != self.data_path or not os.path.exists(filepath):
+                    continue
+                settling[filepath] = time.time() + self.settle_time
+                try:
+                    rf = ReapPFile(filepath, self)
+                except OSError:
+                    continue
+                mf = self.monitored_files.get(filepath)
+                if not mf or mf.size != rf.size:
+                    self.monitored_files[filepath] = rf
+        return []
+
+    def reap(self, rf):
+        rf.reap()
+        if not rf.needs_reaping:
+            nimsutil.update_reference_datetime(self.datetime_file, rf.mod_time)
+            self.current_file_timestamp = rf.mod_time
 
 
 class ReapPFile(object):
@@ -129,8 +172,10 @@ class ReapPFile(object):
         else:
             log.info('Compressing %s' % self)
             nimsutil.gzip_inplace(os.path.join(reap_path, self.basename), 0o644)
+            nimsutil.write_complete_marker(reap_path, [self.basename + '.gz'])
             shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
             os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
+            self.reaper.notifier.notify('nims_stage')
             self.needs_reaping = False
             log.info('Reaped      %s' % self)
 
@@ -145,6 +190,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-p', '--patid', help='glob for patient IDs to reap (default: "*")')
         self.add_argument('-d', '--discard', default='discard', help='space-separated list of Patient IDs to discard')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-N', '--notify', help='postgresql URI or socket directory to notify of staged data')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -157,7 +203,8 @@ if __name__ == '__main__':
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % reaper_id)
 
-    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file, args.sleeptime)
+    notifier = nimsutil.Notifier.from_uri(args.notify)
+    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file, args.sleeptime, notifier)
 
     def term_handler(signum, stack):
         reaper.halt()
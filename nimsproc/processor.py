@@ -7,17 +7,25 @@ import os
 import abc
 import glob
 import time
+import errno
+import hashlib
 import shutil
+import socket
 import signal
 import logging
 import tarfile
+import tempfile
 import argparse
 import datetime
 import threading
+import contextlib
+import cPickle as pickle
+import multiprocessing
 import numpy as np
 
 import sqlalchemy
 import transaction
+from zope.sqlalchemy import mark_changed
 
 import nimsutil
 import nimsdata
@@ -30,22 +38,52 @@ from nimsgears.model import *
 log = logging.getLogger('processor')
 
 
+def estimate_memory(filetype, size_x, size_y, num_slices, num_timepoints, num_bands, num_receivers):
+    """
+    Roughly estimate the peak memory, in bytes, needed to process an epoch.
+
+    PFile recons hold the complex k-space of every receiver next to the reconstructed image, and
+    work on copies of both. Dicom conversion only holds the image, and a few copies of it while
+    writing. Unknown dimensions fall back to those of a small scan.
+    """
+    voxels = (size_x or 64) * (size_y or 64) * (num_slices or 1) * (num_timepoints or 1)
+    image_bytes = 4 * voxels                                                # float32 image
+    if filetype == u'pfile':
+        kspace_bytes = 8 * voxels * (num_receivers or 32) / (num_bands or 1)  # complex64, per receiver, per acquired slice
+        return 2 * kspace_bytes + 2 * image_bytes
+    return 3 * image_bytes
+
+
 class Processor(object):
 
-    def __init__(self, db_uri, nims_path, physio_path, task, filters, max_jobs, max_recon_jobs, reset, sleeptime, tempdir, newest):
+    def __init__(self, db_uri, nims_path, physio_path, task, filters, max_jobs, max_recon_jobs, reset, sleeptime, tempdir, newest, executor='thread', lease=300, notify_uri=None, memory=None, recon_slots=None, slot_path=None, cache_path=None, cache_days=7, fairshare='experiment', aging=1.0):
         super(Processor, self).__init__()
+        self.db_uri = db_uri
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.task = unicode(task) if task else None
         self.filters = filters
         self.max_jobs = max_jobs
         self.max_recon_jobs = max_recon_jobs
+        self.recon_slots = nimsutil.SlotPool(slot_path or os.path.join(tempfile.gettempdir(), 'nims_recon_slots'), recon_slots or multiprocessing.cpu_count())
+        self.stage_cache = StageCache(cache_path, datetime.timedelta(days=cache_days)) if cache_path else None
         self.sleeptime = sleeptime
-        self.tempdir = tempdir
+        self.tempdir = tempdir or nimsutil.make_joined_path(nims_path, 'tmp')  # same filesystem, to publish by rename
         self.newest = newest
+        self.fairshare = fairshare
+        self.aging = aging
+        self.executor = executor
+        self.lease = datetime.timedelta(seconds=lease)
+        self.owner = u'%s:%d' % (socket.gethostname(), os.getpid())
+        self.reporter = JobReporter(self.owner, self.lease)
+        self.memory_budget = int(memory * 2**30) if memory else None
+        self.workers = []
+        self.reservations = {}      # estimated memory use of each worker
 
         self.alive = True
-        init_model(sqlalchemy.create_engine(db_uri))
+        self.notifier = nimsutil.Notifier.from_uri(notify_uri or db_uri, 'nims_job')
+        self.engine = sqlalchemy.create_engine(db_uri)
+        init_model(self.engine)
         if reset: self.reset_all()
 
     def halt(self):
@@ -53,18 +91,17 @@ class Processor(object):
 
     def run(self):
         while self.alive:
-            if threading.active_count()-1 < self.max_jobs:
-                query = Job.query.join(DataContainer).join(Epoch)
-                if self.task:
-                    query = query.filter(Job.task==self.task)
-                for f in self.filters:
-                    query = query.filter(eval(f))
-                if self.newest:
-                    job = query.filter(Job.status==u'pending').order_by(Job.id.desc()).with_lockmode('update').first()
-                else:
-                    job = query.filter(Job.status==u'pending').order_by(Job.id).with_lockmode('update').first()
-
-                if job:
+            self.reap_expired()
+            if self.stage_cache:
+                self.stage_cache.prune()
+            for worker in [w for w in self.workers if not w.is_alive() and isinstance(w, PipelineProcess) and w.exitcode]:
+                self.fail_crashed(worker)
+            self.workers = [w for w in self.workers if w.is_alive()]
+            self.reservations = dict((w, m) for w, m in self.reservations.iteritems() if w.is_alive())
+            if len(self.workers) < self.max_jobs:
+                jobs, estimates = self.claim_jobs(self.max_jobs - len(self.workers))
+                workers = []
+                for job in jobs:
                     if isinstance(job.data_container, Epoch) and job.data_container.primary_dataset!=None:
                         ds = job.data_container.primary_dataset
                         if ds.filetype == nimsdata.medimg.nimsdicom.NIMSDicom.filetype:
@@ -72,55 +109,305 @@ class Processor(object):
                         elif ds.filetype == nimsdata.medimg.nimspfile.NIMSPFile.filetype:
                             pipeline_class = PFilePipeline
 
-                        pipeline = pipeline_class(job, self.nims_path, self.physio_path, self.tempdir, self.max_recon_jobs)
-                        job.status = u'running'
-                        transaction.commit()
-                        pipeline.start()
+                        pipeline_args = (self.nims_path, self.physio_path, self.tempdir, self.max_recon_jobs, self.recon_slots, self.stage_cache, self.reporter)
+                        if self.executor == 'process':
+                            workers.append(PipelineProcess(job.id, pipeline_class, self.db_uri, *pipeline_args))
+                        else:
+                            workers.append(pipeline_class(job, *pipeline_args))
+                        self.reservations[workers[-1]] = estimates.get(job.id, 0)
                     else:
                         job.status = u'failed'
                         job.activity = u'failed: not an Epoch or no primary dataset.'
                         log.warning(u'%d %s %s ' % (job.id, job, job.activity))
-                        transaction.commit()
-                else:
+                transaction.commit()
+
+                if workers and self.executor == 'process':
+                    self.engine.dispose()   # never share pooled connections with a forked worker
+                for worker in workers:
+                    worker.start()
+                self.workers += workers
+
+                if not jobs:
                     log.debug('Waiting for work...')
-                    time.sleep(self.sleeptime)
+                    self.notifier.wait(self.sleeptime)
             else:
                 log.debug('Waiting for jobs to finish...')
-                time.sleep(self.sleeptime)
+                self.wait_for_workers(self.sleeptime)
+
+    def wait_for_workers(self, timeout):
+        """Wait up to timeout seconds for any worker to finish."""
+        deadline = time.time() + timeout
+        while self.alive and time.time() < deadline and all(w.is_alive() for w in self.workers):
+            time.sleep(1)
+
+    def pending_query(self):
+        """Return a query for the pending jobs that this processor may run now."""
+        query = Job.query.join(DataContainer).join(Epoch).filter(Job.status==u'pending')
+        query = query.filter((Job.notbefore == None) | (Job.notbefore <= datetime.datetime.now()))
+        if self.task:
+            query = query.filter(Job.task==self.task)
+        for f in self.filters:
+            query = query.filter(eval(f))
+        return query
+
+    def rank(self, query, limit):
+        """
+        Return the ids of up to limit jobs of query, best first.
+
+        A job scores its priority, plus aging points per hour it has waited since it was last queued,
+        minus one point for each job of the same experiment (or research group) that is running or
+        ranked ahead of it. Live scans, which the scheduler queues with a high priority, thus overtake
+        backfill and reruns, one large session or bulk reprocessing cannot starve other experiments,
+        and every job runs eventually.
+        Ties go to the oldest job, or the newest with --newest.
+        """
+        if self.fairshare == 'group':
+            share = Experiment.table.c.owner_id
+        else:
+            share = Subject.table.c.experiment_id
+        def with_share(query):
+            return (query
+                    .join(Session.table, Session.table.c.id == Epoch.table.c.session_id)
+                    .join(Subject.table, Subject.table.c.id == Session.table.c.subject_id)
+                    .join(Experiment.table, Experiment.table.c.id == Subject.table.c.experiment_id))
+
+        now = datetime.datetime.now()
+        shares = dict(with_share(Job.query.join(DataContainer).join(Epoch).filter(Job.status == u'running'))
+                .with_entities(share, sqlalchemy.func.count(Job.id)).group_by(share).all())
+        candidates = []
+        for job_id, priority, queued, share_id in with_share(query).with_entities(Job.id, Job.priority, Job.queued, share).all():
+            waited = max((now - queued).total_seconds() / 3600, 0) if queued else 0
+            candidates.append((job_id, (priority or 0) + self.aging * waited, share_id))
+        order = 1 if self.newest else -1
+        ranked = []
+        while candidates and len(ranked) < limit:
+            best = max(candidates, key=lambda candidate: (candidate[1] - shares.get(candidate[2], 0), order * candidate[0]))
+            candidates.remove(best)
+            ranked.append(best[0])
+            shares[best[2]] = shares.get(best[2], 0) + 1
+        return ranked
+
+    def admit(self, query, job_ids, limit):
+        """
+        Select up to limit of the ranked job_ids of query that fit into the free memory budget, in rank order.
+
+        Return a dictionary of job ids and their estimated memory use. A job that does not fit
+        keeps its place in the queue: its memory is reserved, so that jobs behind it can only be
+        packed into the memory left over, and it is admitted as soon as enough memory is freed. A
+        job larger than the whole budget is admitted when nothing else is running.
+        """
+        available = self.memory_budget - sum(self.reservations.itervalues())
+        candidates = dict((candidate[0], candidate) for candidate in query
+                .filter(Job.id.in_(job_ids))
+                .outerjoin(Dataset, (Dataset.container_id == DataContainer.id) & (Dataset.kind == u'primary'))
+                .with_entities(Job.id, Dataset.filetype, Epoch.size_x, Epoch.size_y, Epoch.num_slices, Epoch.num_timepoints, Epoch.num_bands, Epoch.num_receivers)
+                .all())
+        admitted = {}
+        for candidate in [candidates[job_id] for job_id in job_ids if job_id in candidates]:
+            if len(admitted) == limit:
+                break
+            estimate = estimate_memory(*candidate[1:])
+            if estimate <= available or not (self.reservations or admitted):
+                admitted[candidate[0]] = estimate
+            elif not admitted:
+                log.debug(u'%d waiting for %s of memory' % (candidate[0], nimsutil.hrsize(estimate)))
+            available -= estimate
+        return admitted
+
+    def claim_jobs(self, limit):
+        """
+        Claim up to limit pending jobs, mark them running and lease them to this processor.
+
+        Return the claimed jobs in rank order, and their estimated memory use if a memory budget is set.
+
+        On PostgreSQL, the pending jobs are selected FOR UPDATE SKIP LOCKED, so that concurrent
+        processors claim disjoint sets of jobs in a single round trip instead of queueing on the
+        same row lock. Other databases (e.g. SQLite) fall back to a conditional UPDATE per job,
+        which only succeeds while the job is still pending.
+
+        The claim becomes visible to others with the next transaction.commit().
+        """
+        query = self.pending_query()
+        estimates = {}
+        if self.memory_budget:
+            job_ids = self.rank(query, 10 * limit)
+            estimates = self.admit(query, job_ids, limit) if job_ids else {}
+            job_ids = [job_id for job_id in job_ids if job_id in estimates]
+        else:
+            job_ids = self.rank(query, limit)
+        if not job_ids:
+            return [], estimates
+        query = query.filter(Job.id.in_(job_ids))
+
+        if self.engine.dialect.name == 'postgresql':
+            statement = query.with_entities(Job.id).statement.compile(dialect=self.engine.dialect)
+            sql = '%s FOR UPDATE OF %s SKIP LOCKED' % (statement, Job.table.name)
+            claimed = set(row[0] for row in DBSession.connection().execute(sql, statement.params))
+            job_ids = [job_id for job_id in job_ids if job_id in claimed]
+        else:
+            ranked_ids, job_ids = job_ids, []
+            for job_id in ranked_ids:
+                claim = Job.table.update().where((Job.table.c.id == job_id) & (Job.table.c.status == u'pending'))
+                if DBSession.execute(claim.values(status=u'running', owner=self.owner)).rowcount == 1:
+                    job_ids.append(job_id)
+            mark_changed(DBSession())
+
+        jobs = sorted(Job.query.filter(Job.id.in_(job_ids)).all(), key=lambda job: job_ids.index(job.id)) if job_ids else []
+        now = datetime.datetime.now()
+        for job in jobs:
+            job.status = u'running'
+            job.owner = self.owner
+            job.heartbeat = now
+            job.lease_expiry = now + self.lease
+            job.progress = 0
+        return jobs, estimates
+
+    def reap_expired(self):
+        """
+        Reset running jobs with an expired lease to pending.
+
+        A lease expires when the processor that claimed the job has stopped renewing it, i.e. it
+        crashed or lost its database connection. Jobs of healthy processors, on any host, are left
+        alone. Lease times are taken from the local clock, so processor hosts must be kept in sync.
+        """
+        now = datetime.datetime.now()
+        for job in Job.query.filter(Job.status == u'running').filter(Job.lease_expiry < now).with_lockmode('update').all():
+            job.activity = u'lease of %s expired; reset to pending' % job.owner
+            job.status = u'pending'
+            job.owner = None
+            job.lease_expiry = None
+            log.warning(u'%d %s %s' % (job.id, job, job.activity))
+        transaction.commit()
+
+    def fail_crashed(self, worker):
+        """
+        Fail the job of a worker process that died, e.g. killed by the OOM killer during its recon.
+
+        Otherwise, the job would be reset to pending once its lease expired, and crash again.
+        """
+        job = Job.query.filter_by(id=worker.job_id, status=u'running', owner=self.owner).with_lockmode('update').first()
+        if job:
+            cause = u'killed by signal %d' % -worker.exitcode if worker.exitcode < 0 else u'exit code %d' % worker.exitcode
+            job.status = u'failed'
+            job.activity = u'failed: worker process died (%s)' % cause
+            job.lease_expiry = None
+            log.warning(u'%d %s %s' % (job.id, job, job.activity))
+        transaction.commit()
 
     def reset_all(self):
-        """Reset all running of failed jobs to pending."""
-        job_query = Job.query.filter((Job.status == u'running') | (Job.status == u'failed'))
+        """Reset all failed jobs, and running jobs without a live lease, to pending."""
+        no_lease = (Job.lease_expiry == None) | (Job.lease_expiry < datetime.datetime.now())
+        job_query = Job.query.filter(((Job.status == u'running') & no_lease) | (Job.status == u'failed'))
         if self.task:
             job_query = job_query.filter(Job.task==self.task)
         for job in job_query.all():
             job.status = u'pending'
+            job.owner = None
+            job.lease_expiry = None
             job.activity = u'reset to pending'
+            job.queued = datetime.datetime.now()
             log.info(u'%d %s %s' % (job.id, job, job.activity))
         transaction.commit()
 
 
+class StageCache(object):
+
+    """
+    Content addressed cache of reconstructed pfile data, shared by the processors on a host or cluster.
+
+    An entry holds the nifti files, the image array and the attributes set by the recon. Its key covers
+    the digest of the primary dataset and everything else the recon depends on, so that a rerun of an
+    unchanged pfile skips extraction, recon and nifti conversion. Entries unused for max_age are pruned.
+    """
+
+    version = 1
+
+    def __init__(self, path, max_age):
+        self.path = nimsutil.make_joined_path(path)
+        self.max_age = max_age
+        self.last_prune = 0
+
+    def key(self, *params):
+        return hashlib.sha1(repr((self.version,) + params)).hexdigest()
+
+    def get(self, key, outputdir):
+        """Copy the files of a cached entry into outputdir, and return its attributes and data, or None on a miss."""
+        entry_path = os.path.join(self.path, key)
+        if not os.path.isdir(entry_path):
+            return None
+        try:
+            with open(os.path.join(entry_path, 'attributes.pickle'), 'rb') as fd:
+                attributes = pickle.load(fd)
+            data = np.load(os.path.join(entry_path, 'data.npy'))
+            for f in os.listdir(os.path.join(entry_path, 'files')):
+                shutil.copy2(os.path.join(entry_path, 'files', f), outputdir)
+            os.utime(entry_path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError) as ex:
+            log.warning('ignoring unreadable cache entry %s: %s' % (key, ex))
+            return None
+        return attributes, data
+
+    def put(self, key, attributes, data, filepaths):
+        """Store an entry, unless it cannot be written or another processor stored it first."""
+        temp_path = tempfile.mkdtemp(dir=self.path, prefix='.')
+        try:
+            with open(os.path.join(temp_path, 'attributes.pickle'), 'wb') as fd:
+                pickle.dump(attributes, fd, pickle.HIGHEST_PROTOCOL)
+            np.save(os.path.join(temp_path, 'data.npy'), data)
+            os.mkdir(os.path.join(temp_path, 'files'))
+            for filepath in filepaths:
+                shutil.copy2(filepath, os.path.join(temp_path, 'files'))
+            os.chmod(temp_path, 0o775)  # mkdtemp's 0700 would hide the entry from processors running as other users
+            os.rename(temp_path, os.path.join(self.path, key))
+        except (pickle.PicklingError, TypeError) as ex:
+            log.warning('not caching %s: %s' % (key, ex))
+            shutil.rmtree(temp_path, ignore_errors=True)
+        except (IOError, OSError) as ex:
+            if getattr(ex, 'errno', None) not in (errno.EEXIST, errno.ENOTEMPTY):
+                log.warning('not caching %s: %s' % (key, ex))
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def prune(self, interval=3600):
+        """Remove entries that were not used for max_age, at most once per interval seconds."""
+        if time.time() - self.last_prune < interval:
+            return
+        self.last_prune = time.time()
+        oldest = self.last_prune - self.max_age.total_seconds()
+        for key in os.listdir(self.path):
+            entry_path = os.path.join(self.path, key)
+            if not key.startswith('.') and os.path.getmtime(entry_path) < oldest:
+                log.info('pruning cache entry %s' % key)
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+
 class Pipeline(threading.Thread):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, job, nims_path, physio_path, tempdir, max_recon_jobs):
+    def __init__(self, job, nims_path, physio_path, tempdir, max_recon_jobs, recon_slots, stage_cache, reporter):
         super(Pipeline, self).__init__()
         self.job = job
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.tempdir = tempdir
         self.max_recon_jobs = max_recon_jobs
+        self.recon_slots = recon_slots
+        self.stage_cache = stage_cache
+        self.reporter = reporter
+        self.activity = None
+        self.stages = []
 
     def run(self):
         DBSession.add(self.job)
-        self.job.activity = u'started %s' % self.job.data_container.primary_dataset.filetype
-        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-        transaction.commit()
-        DBSession.add(self.job)
+        self.job_id = self.job.id
+        self.label = u'%d %s' % (self.job.id, self.job)
+        self.reporter.register(self.job_id)
+        self.report(u'started %s' % self.job.data_container.primary_dataset.filetype, 0)
         try:
             if self.job.task == u'find&proc':
                 self.process()  # process now includes find.
+            elif self.job.task == u'find':
+                self.refind()
         except Exception as ex:
             self.job.status = u'failed'
             self.job.activity = (u'failed: %s' % ex)[:255]
@@ -128,9 +415,74 @@ class Pipeline(threading.Thread):
         else:
             self.job.status = u'done'
             self.job.activity = u'done'
+            self.job.progress = 100
             log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+        self.reporter.unregister(self.job_id)    # the final state is committed below
+        self.job.lease_expiry = None
+        for stage in self.stages:
+            JobStage(job=self.job, **stage)
         transaction.commit()
 
+    def report(self, activity, progress=None):
+        """Log a new activity, and have the reporter write it, and the progress in percent, in the background."""
+        self.activity = activity[:255]
+        log.info(u'%s %s' % (self.label, activity))
+        self.reporter.report(self.job_id, self.activity, progress)
+
+    @contextlib.contextmanager
+    def stage(self, name, path=None):
+        """
+        Time a stage of this pipeline, to be recorded with the job.
+
+        Bytes written are measured as the growth of path, if given. CPU time is taken for the whole
+        process, including its recon child processes, and thus includes concurrent jobs when using
+        the thread executor.
+        """
+        started = datetime.datetime.now()
+        size = nimsutil.disk_usage(path) if path else 0
+        wall, cpu = time.time(), sum(os.times()[:4])
+        try:
+            yield
+        finally:
+            stage = dict(
+                    stage=unicode(name),
+                    started=started,
+                    wall_time=time.time() - wall,
+                    cpu_time=sum(os.times()[:4]) - cpu,
+                    bytes_written=(nimsutil.disk_usage(path) - size) if path else None,
+                    )
+            self.stages.append(stage)
+            log.info(u'%s stage %s: %.1fs wall, %.1fs cpu, %s written' % (self.label, name,
+                    stage['wall_time'], stage['cpu_time'], nimsutil.hrsize(stage['bytes_written'] or 0)))
+
+    def write_outputs(self, acq, outputs):
+        """
+        Write several output formats of acq concurrently, returning the results and exceptions of each nimsdata.write.
+
+        outputs is a list of (stage name, output directory, write options). The writers share the read-only
+        acq.data and do not touch the database. A failed writer leaves its result None and its exception in
+        errors, so that the caller can still publish the outputs that were written, before failing the job.
+        """
+        results = [None] * len(outputs)
+        errors = [None] * len(outputs)
+        outname = self.job.data_container.name
+        self.report(u'writing %s' % ', '.join(output[0] for output in outputs), 70)
+
+        def write(i, name, outputdir, options):
+            try:
+                with self.stage(name, outputdir):
+                    results[i] = nimsdata.write(acq, acq.data, os.path.join(outputdir, outname), **options)
+            except Exception as ex:
+                log.warning(u'%s %s writer failed: %s' % (self.label, name, ex))
+                errors[i] = ex
+
+        writers = [threading.Thread(target=write, args=(i,) + output) for i, output in enumerate(outputs)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        return results, errors
+
     def clean(self, data_container, kind):
         for ds in Dataset.query.filter_by(container=data_container).filter_by(kind=kind).all():
             shutil.rmtree(os.path.join(self.nims_path, ds.relpath))
@@ -177,8 +529,7 @@ class Pipeline(threading.Thread):
             if physio_files:
                 physio = nimsphysio.NIMSPhysio(physio_files, dc.tr, dc.num_timepoints, nimsdata.medimg.medimg.get_slice_order(slice_order, num_slices))
                 if physio.is_valid():
-                    self.job.activity = u'valid physio found (%s...)' % os.path.basename(physio_files[0])
-                    log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                    self.report(u'valid physio found (%s...)' % os.path.basename(physio_files[0]))
                     dataset = Dataset.at_path(self.nims_path, u'physio')
                     DBSession.add(self.job)
                     DBSession.add(self.job.data_container)
@@ -191,46 +542,183 @@ class Pipeline(threading.Thread):
                             shutil.copy2(f, arcdir_path)
                         filename = '%s_physio.tgz' % self.job.data_container.name
                         dataset.filenames = [filename]
-                        with tarfile.open(os.path.join(self.nims_path, dataset.relpath, filename), 'w:gz', compresslevel=6) as archive:
+                        with tarfile.open(os.path.join(tempdir_path, filename), 'w:gz', compresslevel=6) as archive:
                             archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
+                        nimsutil.publish(os.path.join(tempdir_path, filename), os.path.join(self.nims_path, dataset.relpath))
                         try:
                             reg_filename = '%s_physio_regressors.csv.gz' % self.job.data_container.name
-                            physio.write_regressors(os.path.join(self.nims_path, dataset.relpath, reg_filename))
-                            self.job.activity = u'physio regressors %s written' % reg_filename
-                            log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                            physio.write_regressors(os.path.join(tempdir_path, reg_filename))
+                            nimsutil.publish(os.path.join(tempdir_path, reg_filename), os.path.join(self.nims_path, dataset.relpath))
+                            self.report(u'physio regressors %s written' % reg_filename)
                         except nimsphysio.NIMSPhysioError:
-                            self.job.activity = u'error generating regressors from physio data'
-                            log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                            self.report(u'error generating regressors from physio data')
                         else:
                             dataset.filenames += [reg_filename]
                 else:
-                    self.job.activity = u'invalid physio found and discarded'
-                    log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                    self.report(u'invalid physio found and discarded')
             else:
-                self.job.activity = u'no physio files found'
-                log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                self.report(u'no physio files found')
         else:
-            self.job.activity = u'physio not recorded'
-            log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+            self.report(u'physio not recorded')
+        transaction.commit()
+        DBSession.add(self.job)
+
+    def defer_find(self, delay):
+        """Queue a separate find job, to search for physio again after delay, without blocking this job."""
+        dc = self.job.data_container
+        find_job = Job.query.filter_by(data_container=dc).filter_by(task=u'find').first()
+        if not find_job:
+            find_job = Job(data_container=dc, task=u'find')
+        if find_job.status != u'running':
+            find_job.status = u'pending'
+            find_job.notbefore = datetime.datetime.now() + delay
+            find_job.queued = find_job.notbefore
+            find_job.activity = u'searching for physio after %s' % find_job.notbefore.strftime('%H:%M:%S')
+        self.report(u'no physio files found; searching again in %d seconds' % delay.total_seconds())
         transaction.commit()
         DBSession.add(self.job)
 
+    @abc.abstractmethod
+    def refind(self):
+        """Search for physio again, as a separate find job queued by defer_find()."""
+
     @abc.abstractmethod
     def process(self):
         self.clean(self.job.data_container, u'derived')
         self.clean(self.job.data_container, u'web')
         self.clean(self.job.data_container, u'qa')
-        self.job.activity = u'reading data / preparing to run recon'
-        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+        self.report(u'reading data / preparing to run recon', 5)
         transaction.commit()
         DBSession.add(self.job)
 
 
+class JobReporter(object):
+
+    """
+    Background writer of the activity, progress and lease of running jobs.
+
+    Pipelines report to it without waiting on the database. Updates are coalesced per job, so that only
+    the latest activity gets written, and are flushed every interval seconds in a single transaction,
+    which also renews the lease of every registered job once per third of the lease time. A reporter is
+    shared by all pipelines of a process, and starts its thread on first use in each process.
+    """
+
+    def __init__(self, owner, lease, interval=2):
+        self.owner = owner
+        self.lease = lease
+        self.interval = interval
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        """Start the reporter thread, unless already running in this process, e.g. started by another pipeline thread."""
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.lock = threading.Lock()
+            self.flush_lock = threading.Lock()
+            self.jobs = set()
+            self.pending = {}
+            self.renewed = datetime.datetime.min
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()  # only once fully set up, for register() to use
+
+    def register(self, job_id):
+        self.start()
+        with self.lock:
+            self.jobs.add(job_id)
+
+    def unregister(self, job_id):
+        """Stop reporting on a job and renewing its lease, discarding unwritten updates."""
+        with self.flush_lock:   # wait for a flush in progress, which might otherwise overwrite the final state
+            with self.lock:
+                self.jobs.discard(job_id)
+                self.pending.pop(job_id, None)
+
+    def report(self, job_id, activity, progress=None):
+        with self.lock:
+            if job_id in self.jobs:
+                update = self.pending.setdefault(job_id, {})
+                update['activity'] = activity
+                if progress is not None:
+                    update['progress'] = progress
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as ex:     # the thread must outlive any error, or no lease of this process would be renewed
+                log.warning(u'job reporter: %s' % ex)
+
+    def flush(self):
+        with self.flush_lock:
+            now = datetime.datetime.now()
+            with self.lock:
+                updates, self.pending = self.pending, {}
+                renew = now - self.renewed >= self.lease / 3
+                if renew:
+                    updates = dict([(job_id, {}) for job_id in self.jobs] + updates.items())
+            if not updates:
+                return
+            report = Job.table.update()
+            connection = None
+            try:
+                connection = DBSession.bind.connect()
+                trans = connection.begin()
+                for job_id, values in updates.iteritems():
+                    statement = report.where((Job.table.c.id == job_id) & (Job.table.c.owner == self.owner))
+                    if not connection.execute(statement.values(heartbeat=now, lease_expiry=now+self.lease, **values)).rowcount:
+                        log.warning(u'%d lease no longer held by %s' % (job_id, self.owner))
+                trans.commit()
+            except sqlalchemy.exc.SQLAlchemyError as ex:
+                log.warning(u'failed to report on %d jobs: %s' % (len(updates), ex))
+                with self.lock:     # retry with the next flush, unless superseded
+                    for job_id, values in updates.iteritems():
+                        if job_id in self.jobs:
+                            self.pending[job_id] = dict(values, **self.pending.get(job_id, {}))
+            else:
+                if renew:
+                    self.renewed = now
+            finally:
+                if connection:
+                    connection.close()
+
+
+class PipelineProcess(multiprocessing.Process):
+
+    """Run a Pipeline in a worker process, with its own database connection."""
+
+    def __init__(self, job_id, pipeline_class, db_uri, *pipeline_args):
+        super(PipelineProcess, self).__init__()
+        self.job_id = job_id
+        self.pipeline_class = pipeline_class
+        self.db_uri = db_uri
+        self.pipeline_args = pipeline_args
+
+    def run(self):
+        DBSession.remove()
+        init_model(sqlalchemy.create_engine(self.db_uri))
+        job = Job.get(self.job_id)
+        self.pipeline_class(job, *self.pipeline_args).run()    # run the pipeline in this process, not a new thread
+        DBSession.remove()
+
+
 class DicomPipeline(Pipeline):
 
     def find(self, slice_order, num_slices):
         return super(DicomPipeline, self).find(slice_order, num_slices)
 
+    def refind(self):
+        ds = self.job.data_container.primary_dataset
+        dcm_tgz = os.path.join(self.nims_path, ds.relpath, os.listdir(os.path.join(self.nims_path, ds.relpath))[0])
+        with self.stage('parse'):
+            dcm_acq = nimsdata.parse(dcm_tgz, filetype='dicom', load_data=False, ignore_json=True)
+        with self.stage('find'):
+            self.find(dcm_acq.slice_order, dcm_acq.num_slices)
+
     def process(self):
         """"
         Convert a dicom file.
@@ -252,48 +740,39 @@ class DicomPipeline(Pipeline):
         with nimsutil.TempDir(dir=self.tempdir) as outputdir:
             outbase = os.path.join(outputdir, ds.container.name)
             dcm_tgz = os.path.join(self.nims_path, ds.relpath, os.listdir(os.path.join(self.nims_path, ds.relpath))[0])
-            dcm_acq = nimsdata.parse(dcm_tgz, filetype='dicom', load_data=True, ignore_json=True)   # store exception for later...
+            with self.stage('parse'):
+                dcm_acq = nimsdata.parse(dcm_tgz, filetype='dicom', load_data=True, ignore_json=True)   # store exception for later...
 
-            # if physio was not found, wait 30 seconds and search again.
+            # if physio was not found, queue a find job to search again in 30 seconds.
             # this should only run when the job activity is u'no physio files found'
             # if physio not recorded, or physio invalid, don't try again
             try:
-                self.find(dcm_acq.slice_order, dcm_acq.num_slices)
+                with self.stage('find'):
+                    self.find(dcm_acq.slice_order, dcm_acq.num_slices)
             except Exception as e:
                 # this catches some of the non-image scans that do not have
                 # dcm_acq.slice_order and/or dcm_acq.num_slices
                 log.info(str(e))  # do we need this logging message?
-            if self.job.activity == u'no physio files found':
-                self.job.activity = u'no physio files found; searching again in 30 seconds'
-                log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-                time.sleep(30)
-                try:
-                    self.find(dcm_acq.slice_order, dcm_acq.num_slices)
-                except Exception as e:
-                    # this catches some of the non-image scans that do not have
-                    # dcm_acq.slice_order and/or dcm_acq.num_slices
-                    log.info(str(e))  # do we need this logging message?
+            if self.activity == u'no physio files found':
+                self.defer_find(datetime.timedelta(seconds=30))
 
             if dcm_acq.failure_reason:   # implies dcm_acq.data = None
                 # if dcm_acq.failure_reason is set, job has failed
                 # raising an error should cause job.status should to end up 'failed'
-                self.job.activity = (u'load dicom data failed; %s' % str(dcm_acq.failure_reason))
-                transaction.commit()
-                DBSession.add(self.job)
+                self.report(u'load dicom data failed; %s' % str(dcm_acq.failure_reason))
                 raise dcm_acq.failure_reason
 
             if dcm_acq.is_non_image:    # implies dcm_acq.data = None
                 # non-image is an "expected" outcome, job has succeeded
                 # no error should be raised, job status should end up 'done'
-                self.job.activity = (u'dicom %s is a non-image type' % dcm_tgz)
-                transaction.commit()
+                self.report(u'dicom %s is a non-image type' % dcm_tgz)
             else:
                 if dcm_acq.is_screenshot:
-                    conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='png')
+                    with self.stage('bitmap', outputdir):
+                        conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='png')
                     if conv_files:
                         outputdir_list = os.listdir(outputdir)
-                        self.job.activity = (u'generated %s' % (', '.join([f for f in outputdir_list])))[:255]
-                        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                        self.report(u'generated %s' % (', '.join([f for f in outputdir_list])), 85)
                         conv_ds = Dataset.at_path(self.nims_path, u'bitmap')
                         DBSession.add(self.job)
                         DBSession.add(self.job.data_container)
@@ -305,57 +784,173 @@ class DicomPipeline(Pipeline):
                         conv_ds.container.num_timepoints = dcm_acq.num_timepoints
                         conv_ds.container.duration = dcm_acq.duration
                         filenames = []
-                        for f in outputdir_list:
-                            filenames.append(f)
-                            shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
+                        with self.stage('publish', os.path.join(self.nims_path, conv_ds.relpath)):
+                            for f in outputdir_list:
+                                filenames.append(f)
+                                nimsutil.publish(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
                         conv_ds.filenames = filenames
                         transaction.commit()
                 else:
-                    conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='nifti')
+                    nifti_dir = os.path.join(outputdir, 'nifti')
+                    pyramid_dir = os.path.join(outputdir, 'img_pyr')
+                    os.mkdir(nifti_dir)
+                    os.mkdir(pyramid_dir)
+                    voxel_order = None if dcm_acq.is_localizer else 'LPS'
+                    (conv_files, nims_montage), errors = self.write_outputs(dcm_acq, [
+                            ('nifti', nifti_dir, dict(filetype='nifti')),
+                            ('montage', pyramid_dir, dict(filetype='montage', voxel_order=voxel_order)),
+                            ])
                     if conv_files:
                         # if nifti was successfully created
-                        outputdir_list = os.listdir(outputdir)
-                        self.job.activity = (u'generated %s' % (', '.join([f for f in outputdir_list])))[:255]
-                        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                        outputdir_list = os.listdir(nifti_dir)
+                        self.report(u'generated %s' % (', '.join([f for f in outputdir_list])), 85)
                         conv_ds = Dataset.at_path(self.nims_path, u'nifti')
                         DBSession.add(self.job)
                         DBSession.add(self.job.data_container)
                         conv_ds.kind = u'derived'
                         conv_ds.container = self.job.data_container
                         filenames = []
-                        for f in outputdir_list:
-                            filenames.append(f)
-                            shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
+                        with self.stage('publish', os.path.join(self.nims_path, conv_ds.relpath)):
+                            for f in outputdir_list:
+                                filenames.append(f)
+                                nimsutil.publish(os.path.join(nifti_dir, f), os.path.join(self.nims_path, conv_ds.relpath))
                         conv_ds.filenames = filenames
                         transaction.commit()
+                    if conv_files and not errors[1]:
                         pyramid_ds = Dataset.at_path(self.nims_path, u'img_pyr')
                         DBSession.add(self.job)
                         DBSession.add(self.job.data_container)
-                        outpath = os.path.join(self.nims_path, pyramid_ds.relpath, self.job.data_container.name)
-                        voxel_order = None if dcm_acq.is_localizer else 'LPS'
-                        nims_montage = nimsdata.write(dcm_acq, dcm_acq.data, outpath, filetype='montage', voxel_order=voxel_order)
-                        self.job.activity = (u'generated %s' % (', '.join([os.path.basename(f) for f in nims_montage])))[:255]
-                        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                        with self.stage('publish', os.path.join(self.nims_path, pyramid_ds.relpath)):
+                            for f in os.listdir(pyramid_dir):
+                                nimsutil.publish(os.path.join(pyramid_dir, f), os.path.join(self.nims_path, pyramid_ds.relpath))
+                        self.report(u'generated %s' % (', '.join([os.path.basename(f) for f in nims_montage])), 95)
                         pyramid_ds.kind = u'web'
                         pyramid_ds.container = self.job.data_container
                         pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
                         transaction.commit()
+                    if errors[0] or errors[1]:
+                        raise errors[0] or errors[1]     # only once the outputs that were written are published
 
             DBSession.add(self.job)
 
         DBSession.add(self.job)
 
 
+class MuxCalibrationIndex(object):
+
+    """
+    Per-session index of the mux epochs that can serve as calibration scans, and their aux files.
+
+    The index of a session is built with one query, and then only picks up epochs added since. It is
+    rebuilt after ttl seconds, to see epochs that were trashed or edited. Aux files are globbed once
+    per epoch, and again if the sorter has since replaced them.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def epochs(self, session):
+        """Return the indexed mux epochs of a session, grouped by (size_x, size_y)."""
+        now = time.time()
+        for session_id in [sid for sid, index in self.sessions.iteritems() if now - index['built'] > self.ttl]:
+            del self.sessions[session_id]
+        index = self.sessions.setdefault(session.id, {'built': now, 'last_id': 0, 'epochs': {}})
+        query = (DBSession.query(Epoch.id, Epoch.series, Epoch.description, Epoch.size_x, Epoch.size_y, Epoch.num_bands, Epoch.num_mux_cal_cycle, Dataset)
+                .outerjoin(Dataset, (Dataset.container_id == Epoch.id) & (Dataset.kind == u'primary'))
+                .filter(Epoch.session == session)
+                .filter(Epoch.trashtime == None)
+                .filter(Epoch.psd.startswith(u'mux'))
+                .filter(Epoch.id > index['last_id']))
+        for epoch_id, series, description, size_x, size_y, num_bands, num_mux_cal_cycle, dataset in query.all():
+            index['epochs'].setdefault((size_x, size_y), []).append({
+                    'id': epoch_id, 'series': series, 'description': description or u'', 'num_bands': num_bands,
+                    'num_mux_cal_cycle': num_mux_cal_cycle, 'relpath': dataset and dataset.relpath})
+            index['last_id'] = max(index['last_id'], epoch_id)
+        return index['epochs']
+
+    def aux_file(self, epoch, nims_path):
+        """Return the aux file of an indexed epoch: a pfile tgz, or a P?????.7 with adjacent files."""
+        if not (epoch.get('aux_file') and os.path.exists(epoch['aux_file'])) and epoch['relpath']:
+            aux_tgz = glob.glob(os.path.join(nims_path, epoch['relpath'], '*_pfile.tgz'))
+            aux_7gz = sorted(glob.glob(os.path.join(nims_path, epoch['relpath'], 'P?????.7*')))
+            epoch['aux_file'] = (aux_tgz or aux_7gz or [None])[0]
+        return epoch.get('aux_file')
+
+    def find(self, target, pf, nims_path):
+        """
+        Return the aux file with the best calibration scan for a multiband pfile, or None.
+
+        Certain mux_epi scans need an aux_file that contains the calibration scans. Single-band scans of the
+        same size are preferred, then, if the pfile has no internal calibration, mux scans with at least two
+        calibration cycles.
+        """
+        with self.lock:
+            candidates = [e for e in self.epochs(target.session).get((pf.size[0], pf.size[1]), []) if e['id'] != target.id]
+
+            log.info('looking for single-band mux calibration scans...')
+            epochs = [e for e in candidates if e['num_bands'] == 1]
+            if len(epochs)==0:
+                if pf.num_mux_cal_cycle<2:
+                    epochs = [e for e in candidates if e['num_mux_cal_cycle']>=2]
+                    log.info('No single-band scan found; %d mux candidates found...' % len(epochs))
+                else:
+                    log.info('No single-band cal scan found-- using internal calibration.')
+            else:
+                log.info('Single-band calibration candidates: %s' % str([e['id'] for e in epochs]))
+
+            # REALLY BAD MUX HACK!
+            # prefer pe0 scans. Ideally, we'd check the pfile headers and find matching pepolar scans.
+            # But that would take forever, so we'll assume target scans are always pe0 and further assume that
+            # the pepolar is correctly indicated in the description.
+            epochs = [e for e in epochs if (not 'pe1' in e['description'] and pf.phase_encode_direction==0) or ('pe1' in e['description'] and pf.phase_encode_direction==1)]
+            if len(epochs)==0:
+                log.info('no matching external cal scans found.')
+                return None
+
+            # which epoch has the closest series number
+            series_num_diff = np.array([e['series'] for e in epochs]) - pf.series_no
+            closest = np.min(np.abs(series_num_diff))==np.abs(series_num_diff)
+            # there may be more than one. We prefer the prior scan.
+            closest = np.where(np.min(series_num_diff[closest])==series_num_diff)[0][0]
+            aux_file = self.aux_file(epochs[closest], nims_path)
+            if aux_file:
+                log.info('identified aux_file: %s' % os.path.basename(aux_file))
+            return aux_file
+
+mux_calibration_index = MuxCalibrationIndex()
+
+
 class PFilePipeline(Pipeline):
 
     def find(self, slice_order, num_slices):
         return super(PFilePipeline, self).find(slice_order, num_slices)
 
+    def refind(self):
+        """Search for physio again, parsing only the header of the pfile."""
+        ds = self.job.data_container.primary_dataset
+        with nimsutil.TempDir(dir=self.tempdir) as tempdir_path:
+            pfile_tgz = glob.glob(os.path.join(self.nims_path, ds.relpath, '*_pfile.tgz'))
+            pfile_7gz = sorted(glob.glob(os.path.join(self.nims_path, ds.relpath, 'P?????.7*')))
+            if pfile_tgz:
+                input_pfile = nimsutil.extract_heads(pfile_tgz[0], tempdir_path, ['P?????.7'], nimsutil.PFILE_HEADER_SIZE).get('P?????.7')
+            else:
+                input_pfile = pfile_7gz and pfile_7gz[0]
+            if not input_pfile:
+                raise Exception('no pfile input found in %s' % os.path.join(self.nims_path, ds.relpath))
+            with self.stage('parse'):
+                pf = nimsdata.parse(input_pfile, filetype='pfile', ignore_json=True, load_data=False, full_parse=True, tempdir=tempdir_path)
+        with self.stage('find'):
+            self.find(pf.slice_order, pf.num_slices)
+
     def process(self):
         """"
         Convert a pfile.
 
-        Extracts a pfile.tgz into a temporary directory and full_parses the pfile.7.  If an error occurs
+        Reads the P?????.7.gz of a dataset directory, next to its aux files, or streams a legacy pfile.tgz into a
+        temporary directory and full_parses the pfile.7 as soon as its header has been extracted, while the rest
+        of the archive is still being extracted.  If an error occurs
         during parsing, no exception gets raised, instead the exception is saved into dataset.failure_reason.
         This is to allow find() to attempt to locate physio, even if the input pfile not be loaded.  After
         locating physio has been attempted, the PFilePipeline will attempt to convert the dataset into
@@ -373,19 +968,19 @@ class PFilePipeline(Pipeline):
         ds = self.job.data_container.primary_dataset
         log.info('Processing ' + ds.container.description)
 
-        with nimsutil.TempDir(dir=self.tempdir) as outputdir:
+        with nimsutil.TempDir(dir=self.tempdir) as outputdir, nimsutil.TarStream(outputdir) as extractor:
             log.debug('parsing')
-            outbase = os.path.join(outputdir, ds.container.name)
+            nifti_dir = os.path.join(outputdir, 'nifti')
+            pyramid_dir = os.path.join(outputdir, 'img_pyr')
+            os.mkdir(nifti_dir)
+            os.mkdir(pyramid_dir)
             pfile_tgz = glob.glob(os.path.join(self.nims_path, ds.relpath, '*_pfile.tgz'))
-            pfile_7gz = glob.glob(os.path.join(self.nims_path, ds.relpath, 'P?????.7*'))
+            pfile_7gz = sorted(glob.glob(os.path.join(self.nims_path, ds.relpath, 'P?????.7*')))
             if pfile_tgz:
                 log.debug('input format: tgz')
-                from subprocess import call
-                call(['tar', '--use-compress-program=pigz', '-xf', pfile_tgz[0], '-C', outputdir])
-                #with tarfile.open(pfile_tgz[0]) as archive:
-                #    archive.extractall(path=outputdir)
-                temp_datadir = os.path.join(outputdir, os.listdir(outputdir)[0])
-                input_pfile = os.path.join(temp_datadir, glob.glob(os.path.join(temp_datadir, 'P?????.7'))[0])
+                # extraction continues in the background; parsing only needs the header at the start of the pfile
+                extractor.extract(pfile_tgz[0])
+                input_pfile = extractor.wait_for('P?????.7', nimsutil.PFILE_HEADER_SIZE)
             elif pfile_7gz:
                 log.debug('input format: directory')
                 input_pfile = pfile_7gz[0]
@@ -401,10 +996,12 @@ class PFilePipeline(Pipeline):
             else:
                 recon_type = None
             log.info('Selecting recon_type %s...' % recon_type)
-            pf = nimsdata.parse(input_pfile, filetype='pfile', ignore_json=True, load_data=False, full_parse=True, tempdir=outputdir, num_jobs=self.max_recon_jobs, recon_type=recon_type)
+            with self.stage('parse'):
+                pf = nimsdata.parse(input_pfile, filetype='pfile', ignore_json=True, load_data=False, full_parse=True, tempdir=outputdir, num_jobs=self.max_recon_jobs, recon_type=recon_type)
 
             try:
-                self.find(pf.slice_order, pf.num_slices)
+                with self.stage('find'):
+                    self.find(pf.slice_order, pf.num_slices)
             except Exception as exc:  # XXX, specific exceptions
                 pass
 
@@ -413,69 +1010,39 @@ class PFilePipeline(Pipeline):
             # help locate an aux_file that contains necessary calibration scans.
             aux_file = None
             if pf.psd_type=='muxepi' and pf.num_bands>1:
-                q = Epoch.query.filter(Epoch.session==self.job.data_container.session).filter(Epoch.trashtime==None).filter(Epoch.psd.startswith(u'mux')).filter(Epoch.size_x==pf.size[0]).filter(Epoch.size_y==pf.size[1])
-
-                log.info('looking for single-band mux calibration scans...')
-                epochs = [e for e in q.all() if e!=self.job.data_container and e.num_bands==1 ]
-                if len(epochs)==0:
-                    if pf.num_mux_cal_cycle<2:
-                        epochs = [e for e in q.all() if e!=self.job.data_container and e.num_mux_cal_cycle>=2]
-                        log.info('No single-band scan found; %d mux candidates found...' % len(epochs))
-                    else:
-                        log.info('No single-band cal scan found-- using internal calibration.')
-                else:
-                    log.info('Single-band calibration candidates: %s' % str([e.primary_dataset.filenames for e in epochs]))
-
-                # REALLY BAD MUX HACK!
-                # prefer pe0 scans. Ideally, we'd check the pfile headers and find matching pepolar scans.
-                # But that would take forever, so we'll assume target scans are always pe0 and further assume that
-                # the pepolar is correctly indicated in the description.
-                epochs_pe_match = [e for e in epochs if (not 'pe1' in e.description and pf.phase_encode_direction==0) or ('pe1' in e.description and pf.phase_encode_direction==1)]
-                if len(epochs_pe_match)>0:
-                    epochs = epochs_pe_match
-                    log.debug('Selecting only epochs with "pe0" in the description')
-                else:
-                    epochs = []
-                    #epochs_pe0 = [e for e in epochs if not 'pe1' in e.description]
-                    #if len(epochs_pe0)>0:
-                    #    epochs = epochs_pe0
-                    #    log.debug('Selecting only epochs without "pe1" in the description')
-
-                if len(epochs)>0:
-                    # which epoch has the closest series number
-                    series_num_diff = np.array([e.series for e in epochs]) - pf.series_no
-                    closest = np.min(np.abs(series_num_diff))==np.abs(series_num_diff)
-                    # there may be more than one. We prefer the prior scan.
-                    closest = np.where(np.min(series_num_diff[closest])==series_num_diff)[0][0]
-                    candidate = epochs[closest]
-                    # auxfile could be either P7.gz with adjacent files or a pfile tgz
-                    aux_tgz = glob.glob(os.path.join(self.nims_path, candidate.primary_dataset.relpath, '*_pfile.tgz'))
-                    aux_7gz = glob.glob(os.path.join(self.nims_path, candidate.primary_dataset.relpath, 'P?????.7*'))
-                    if aux_tgz:
-                        aux_file = aux_tgz[0]
-                    elif aux_7gz:
-                        aux_file = aux_7gz[0]
-                    # aux_file = os.path.join(self.nims_path, candidate.primary_dataset.relpath, candidate.primary_dataset.filenames[0])
-                    log.info('identified aux_file: %s' % os.path.basename(aux_file))
-
-                    self.job.activity = (u'Found aux file: %s' % os.path.basename(aux_file))[:255]
-                    log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-                else:
-                    log.info('no matching external cal scans found.')
-                    aux_file = None
-
-            else:
-                aux_file = None
+                aux_file = mux_calibration_index.find(self.job.data_container, pf, self.nims_path)
+                if aux_file:
+                    self.report(u'Found aux file: %s' % os.path.basename(aux_file), 20)
 
             # provide aux_files and db_description to pfile.load_data.  aux_file will be used for calibration scan,
             # db_desc passes the database description to the pfile.load_data fxn, allowing pfile.load_data() to
             # make additional decisions based on the description stored in the database.
             # This allows user-edits to the description to affect jobs.
-            pf.load_data(aux_file=aux_file, db_desc=self.job.data_container.description)
+            # recon workers are drawn from the host-wide pool of recon slots, shared with all other pipelines
+            cache_key = None
+            cached = None
+            if self.stage_cache and ds.digest:
+                aux_stat = os.stat(aux_file) if aux_file else None
+                cache_key = self.stage_cache.key(ds.digest.encode('hex'), recon_type, aux_file, aux_stat and (aux_stat.st_size, aux_stat.st_mtime), self.job.data_container.description)
+                cached = self.stage_cache.get(cache_key, nifti_dir)
+            if cached:
+                extractor.close()   # the rest of the pfile is not needed
+                pf.__dict__.update(cached[0])
+                pf.data = cached[1]
+                self.report(u'reusing cached recon %s' % cache_key, 60)
+            else:
+                if pfile_tgz:
+                    with self.stage('extract', outputdir):
+                        extractor.join()
+                attributes = dict(pf.__dict__)
+                with self.recon_slots.acquire(self.max_recon_jobs) as num_jobs, self.stage('recon'):
+                    self.report(u'reconstructing with %d of %d workers' % (num_jobs, self.max_recon_jobs), 30)
+                    pf.num_jobs = num_jobs
+                    pf.load_data(aux_file=aux_file, db_desc=self.job.data_container.description)
+                # the attributes set by the recon, to be cached along with the data
+                attributes = dict((k, v) for k, v in pf.__dict__.iteritems() if k != 'data' and (k not in attributes or attributes[k] is not v))
             if pf.failure_reason:   # implies pf.data = None
-                self.job.activity = (u'error loading pfile: %s' % str(pf.failure_reason))
-                transaction.commit()
-                DBSession.add(self.job)
+                self.report(u'error loading pfile: %s' % str(pf.failure_reason))
                 raise pf.failure_reason
 
             # attempt to write nifti, if write fails, let exception bubble up to pipeline process()
@@ -483,14 +1050,19 @@ class PFilePipeline(Pipeline):
             if pf.is_non_image:    # implies dcm_acq.data = None
                 # non-image is an "expected" outcome, job has succeeded
                 # no error should be raised, job status should end up 'done'
-                self.job.activity = (u'pfile %s is a non-image type' % input_pfile)
-                transaction.commit()
+                self.report(u'pfile %s is a non-image type' % input_pfile)
             else:
-                conv_file = nimsdata.write(pf, pf.data, outbase, filetype='nifti')
+                outputs = [('montage', pyramid_dir, dict(filetype='montage'))]
+                if not cached:  # otherwise, the nifti files were copied from the cache
+                    outputs.insert(0, ('nifti', nifti_dir, dict(filetype='nifti')))
+                results, errors = self.write_outputs(pf, outputs)
+                conv_file = cached or results[0]
+                nims_montage = results[-1]
                 if conv_file:
-                    outputdir_list = [f for f in os.listdir(outputdir) if not os.path.isdir(os.path.join(outputdir, f))]
-                    self.job.activity = (u'generated %s' % (', '.join([f for f in outputdir_list])))[:255]
-                    log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                    outputdir_list = os.listdir(nifti_dir)
+                    if cache_key and not cached:
+                        self.stage_cache.put(cache_key, attributes, pf.data, [os.path.join(nifti_dir, f) for f in outputdir_list])
+                    self.report(u'generated %s' % (', '.join([f for f in outputdir_list])), 85)
                     dataset = Dataset.at_path(self.nims_path, u'nifti')
                     DBSession.add(self.job)
                     DBSession.add(self.job.data_container)
@@ -502,23 +1074,28 @@ class PFilePipeline(Pipeline):
                     dataset.container.num_timepoints = pf.num_timepoints
                     dataset.container.duration = datetime.timedelta(seconds=pf.duration)
                     filenames = []
-                    for f in outputdir_list:
-                        filenames.append(f)
-                        shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, dataset.relpath))
+                    with self.stage('publish', os.path.join(self.nims_path, dataset.relpath)):
+                        for f in outputdir_list:
+                            filenames.append(f)
+                            nimsutil.publish(os.path.join(nifti_dir, f), os.path.join(self.nims_path, dataset.relpath))
                     dataset.filenames = filenames
                     transaction.commit()
 
+                if conv_file and not errors[-1]:
                     pyramid_ds = Dataset.at_path(self.nims_path, u'img_pyr')
                     DBSession.add(self.job)
                     DBSession.add(self.job.data_container)
-                    outpath = os.path.join(self.nims_path, pyramid_ds.relpath, self.job.data_container.name)
-                    nims_montage = nimsdata.write(pf, pf.data, outpath, filetype='montage')
-                    self.job.activity = u'generated image pyramid %s' % nims_montage
-                    log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+                    with self.stage('publish', os.path.join(self.nims_path, pyramid_ds.relpath)):
+                        for f in os.listdir(pyramid_dir):
+                            nimsutil.publish(os.path.join(pyramid_dir, f), os.path.join(self.nims_path, pyramid_ds.relpath))
+                    self.report(u'generated image pyramid %s' % nims_montage, 95)
                     pyramid_ds.kind = u'web'
                     pyramid_ds.container = self.job.data_container
                     pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
                     transaction.commit()
+                errors = [error for error in errors if error]
+                if errors:
+                    raise errors[0]     # only once the outputs that were written are published
 
             DBSession.add(self.job)
 
@@ -534,15 +1111,25 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('physio_path', metavar='PHYSIO_PATH', nargs='?', help='path to physio data')
         self.add_argument('-T', '--task', help='find|proc  (default is all)')
         self.add_argument('-e', '--filter', default=[], action='append', help='sqlalchemy filter expression')
-        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent threads')
-        self.add_argument('-k', '--reconjobs', type=int, default=8, help='maximum number of concurrent recon jobs')
-        self.add_argument('-r', '--reset', action='store_true', help='reset currently active (crashed) jobs')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent jobs')
+        self.add_argument('-x', '--executor', choices=['thread', 'process'], default='thread', help='run jobs in threads or worker processes (default: thread)')
+        self.add_argument('-k', '--reconjobs', type=int, default=8, help='maximum number of concurrent recon jobs per pipeline')
+        self.add_argument('-K', '--reconslots', type=int, help='maximum number of recon jobs on this host, across all pipelines and processors (default: number of cpus)')
+        self.add_argument('--slotdir', help='directory for the recon slot lock files shared by processors on this host')
+        self.add_argument('-C', '--cachedir', help='directory to cache reconstructed pfiles in, so that reruns can skip the recon (default: no cache)')
+        self.add_argument('--cachedays', type=float, default=7, help='days before an unused cache entry is pruned (default: 7)')
+        self.add_argument('-m', '--memory', type=float, help='memory budget for concurrent jobs, in GB (default: unlimited)')
+        self.add_argument('-r', '--reset', action='store_true', help='reset failed jobs and running jobs without a live lease')
+        self.add_argument('-L', '--lease', type=int, default=300, help='seconds before a job without heartbeat is reset (default: 300)')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
-        self.add_argument('-t', '--tempdir', help='directory to use for temporary files')
+        self.add_argument('-t', '--tempdir', help='directory to use for temporary files (default: DATA_PATH/tmp, to publish outputs by rename)')
+        self.add_argument('-N', '--notify', help='postgresql URI or socket directory to listen on for new jobs (default: database URI)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
-        self.add_argument('-n', '--newest', action='store_true', default=False, help='do newest jobs first')
+        self.add_argument('-n', '--newest', action='store_true', default=False, help='do newest jobs first, among jobs of equal score')
+        self.add_argument('-F', '--fairshare', choices=['experiment', 'group'], default='experiment', help='share processing fairly among experiments or research groups (default: experiment)')
+        self.add_argument('-A', '--aging', type=float, default=1, help='priority gained per hour of waiting in the queue (default: 1)')
 
 
 if __name__ == '__main__':
@@ -551,7 +1138,7 @@ if __name__ == '__main__':
 
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, args.filter, args.jobs, args.reconjobs, args.reset, args.sleeptime, args.tempdir, args.newest)
+    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, args.filter, args.jobs, args.reconjobs, args.reset, args.sleeptime, args.tempdir, args.newest, args.executor, args.lease, args.notify, args.memory, args.reconslots, args.slotdir, args.cachedir, args.cachedays, args.fairshare, args.aging)
 
     def term_handler(signum, stack):
         processor.halt()
@@ -3,7 +3,6 @@
 # @author:  Gunnar Schaefer
 
 import os
-import time
 import shlex
 import shutil
 import signal
@@ -17,10 +16,12 @@ log = logging.getLogger('restager')
 
 
 class Restager(object):
-    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time):
+    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time, notifier=None):
         super(Restager, self).__init__()
         self.source_stage = source_stage
         self.sleep_time = sleep_time
+        self.notifier = notifier or nimsutil.Notifier()
+        self.notifier.watch(self.source_stage)
         self.alive = True
 
         self.scp_cmd = 'rsync -a %%s %s:%s' % (data_host, reap_stage)
@@ -52,10 +53,11 @@ class Restager(object):
                         shutil.rmtree(item_path)
                     else:
                         os.remove(item_path)
+                    self.notifier.notify('nims_stage')
                     log.info('Restaged  %s' % os.path.basename(item_path))
             else:
                 log.debug('Waiting for work...')
-                time.sleep(self.sleep_time)
+                self.notifier.wait(self.sleep_time)
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -65,6 +67,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('data_host', help='username@hostname of data destination')
         self.add_argument('remote_stage', help='path to destination staging area')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-N', '--notify', help='postgresql URI of the destination database to notify of staged data')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -78,7 +81,8 @@ if __name__ == "__main__":
     reap_stage = nimsutil.make_joined_path(args.remote_stage, 'reap')
     sort_stage = nimsutil.make_joined_path(args.remote_stage, 'sort')
 
-    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime)
+    notifier = nimsutil.Notifier.from_uri(args.notify)
+    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime, notifier)
 
     def term_handler(signum, stack):
         restager.halt()
@@ -3,13 +3,14 @@
 # @author:  Gunnar Schaefer
 
 import os
-import time
+import json
 import shutil
 import signal
 import logging
-import tarfile
 import argparse
 import datetime
+import multiprocessing
+import multiprocessing.pool
 
 import sqlalchemy
 import transaction
@@ -23,13 +24,20 @@ log = logging.getLogger('scheduler')
 
 class Scheduler(object):
 
-    def __init__(self, db_uri, nims_path, sleeptime, cooltime):
+    def __init__(self, db_uri, nims_path, sleeptime, cooltime, notify_uri=None, livetime=24, livepriority=10, workers=None):
         super(Scheduler, self).__init__()
         self.nims_path = nims_path
         self.sleeptime = sleeptime
         self.cooltime = datetime.timedelta(seconds=cooltime)
+        self.livetime = datetime.timedelta(hours=livetime)
+        self.livepriority = livepriority
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = multiprocessing.pool.ThreadPool(self.workers)
+        self.compressing = set()    # ids of data containers queued for compression
+        self.backoff = {}           # ids of data containers whose compression failed: (failures, time of next attempt)
 
         self.alive = True
+        self.notifier = nimsutil.Notifier.from_uri(notify_uri or db_uri, 'nims_dirty')
         init_model(sqlalchemy.create_engine(db_uri))
         self.reset_all()
 
@@ -39,65 +47,130 @@ class Scheduler(object):
     def run(self):
         while self.alive:
             # relaunch jobs that need rerun
-            for job in Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all():
+            rerun_jobs = Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all()
+            for job in rerun_jobs:
                 job.status = u'pending'
                 job.activity = u'reset to pending'
+                job.queued = datetime.datetime.now()
+                job.priority = self.priority(job.data_container)
                 log.info(u'Reset       %s to pending' % job)
                 job.needs_rerun = False
             transaction.commit()
+            if rerun_jobs:
+                self.notifier.notify('nims_job')
 
-            # deal with dirty data containers
-            dc = (DataContainer.query
+            # deal with dirty data containers, leaving those that need compression if all workers are busy
+            # data is left to cool, in case more is coming, unless the sorter marked it complete
+            query = (DataContainer.query
                     .filter(DataContainer.dirty == True)
-                    .filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - self.cooltime)))
-                    .order_by(DataContainer.timestamp).first())
+                    .filter(~DataContainer.datasets.any((Dataset.updatetime > (datetime.datetime.now() - self.cooltime)) & (Dataset.complete != True))))
+            compressing = list(self.compressing)
+            now = datetime.datetime.now()
+            excluded = compressing + [dc_id for dc_id, (failures, retry_time) in self.backoff.items() if retry_time > now]
+            if excluded:        # may turn dirty again while compressing, but must not be compressed twice at once
+                query = query.filter(~DataContainer.id.in_(excluded))
+            if len(compressing) >= self.workers:
+                query = query.filter(~DataContainer.datasets.any(((Dataset.kind == u'primary') | (Dataset.kind == u'secondary')) & (Dataset.compressed != True)))
+            dc = query.order_by(DataContainer.timestamp).first()
             if dc:
                 dc.dirty = False
                 dc.scheduling = True
                 transaction.commit()
                 DBSession.add(dc)
-
-                # compress data if needed
-                for ds in [ds for ds in dc.original_datasets if not ds.compressed]:
-                    log.info(u'Compressing %s %s' % (dc, ds.filetype))
-                    dataset_path = os.path.join(self.nims_path, ds.relpath)
-                    if ds.filetype == nimsdata.nimsdicom.NIMSDicom.filetype:
-                        arcdir = '%s_%s_%s_dicoms' % (dc.session.exam, dc.series, dc.acq)
-                        arcdir_path = os.path.join(dataset_path, arcdir)
+                if [ds for ds in dc.original_datasets if not ds.compressed]:
+                    self.compressing.add(dc.id)
+                    self.pool.apply_async(self.compress_and_schedule, (dc.id,))
+                else:
+                    self.schedule(dc)
+            else:
+                self.notifier.wait(self.sleeptime)
+        self.pool.close()
+        self.pool.join()
+
+    def compress_and_schedule(self, dc_id):
+        """Compress the original datasets of a data container, then schedule its job, on a worker thread."""
+        try:
+            dc = DataContainer.get(dc_id)
+            self.compress(dc)
+            self.schedule(dc)
+            self.backoff.pop(dc_id, None)
+        except Exception as ex:
+            transaction.abort()
+            failures = self.backoff.get(dc_id, (0, None))[0] + 1
+            delay = datetime.timedelta(seconds=min(self.sleeptime * 2 ** failures, 3600))
+            self.backoff[dc_id] = (failures, datetime.datetime.now() + delay)
+            log.warning(u'Failed to compress data container %d: %s; retrying in %d seconds' % (dc_id, ex, delay.total_seconds()))
+            dc = DataContainer.get(dc_id)
+            dc.dirty = True
+            dc.scheduling = False
+            transaction.commit()
+        finally:
+            self.compressing.discard(dc_id)
+            DBSession.remove()
+
+    def compress(self, dc):
+        """Compress the original datasets of a data container, recording the digests of what was compressed in their manifests."""
+        for ds in [ds for ds in dc.original_datasets if not ds.compressed]:
+            log.info(u'Compressing %s %s' % (dc, ds.filetype))
+            dataset_path = os.path.join(self.nims_path, ds.relpath)
+            manifest = {}
+            if ds.filetype == nimsdata.nimsdicom.NIMSDicom.filetype:
+                arcdir = '%s_%s_%s_dicoms' % (dc.session.exam, dc.series, dc.acq)
+                arcdir_path = os.path.join(dataset_path, arcdir)
+                if os.path.exists('%s.tgz' % arcdir_path) and not os.path.isdir(arcdir_path):
+                    manifest = nimsutil.update_manifest(dataset_path)   # archived by a failed attempt, which did not record it
+                else:
+                    if not os.path.isdir(arcdir_path):  # otherwise, left by a failed attempt, with some files already in it
                         os.mkdir(arcdir_path)
-                        for filename in [f for f in os.listdir(dataset_path) if not f.startswith(arcdir)]:
-                            os.rename(os.path.join(dataset_path, filename), os.path.join(arcdir_path, filename))
-                        with tarfile.open('%s.tgz' % arcdir_path, 'w:gz', compresslevel=6) as archive:
-                            archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
-                        shutil.rmtree(arcdir_path)
-                        ds.filenames = os.listdir(dataset_path)
-                        ds.compressed = True
-                        transaction.commit()
-                    elif ds.filetype == nimsdata.nimsraw.NIMSPFile.filetype:
-                        for pfilepath in [os.path.join(dataset_path, f) for f in os.listdir(dataset_path) if not f.startswith('_')]:
-                            nimsutil.gzip_inplace(pfilepath, 0o644)
-                        ds.filenames = os.listdir(dataset_path)
-                        ds.compressed = True
-                        transaction.commit()
-                    DBSession.add(dc)
-
-                # schedule job
-                log.info(u'Inspecting  %s' % dc)
-                new_digest = nimsutil.redigest(os.path.join(self.nims_path, dc.primary_dataset.relpath))
-                if dc.primary_dataset.digest != new_digest:
-                    dc.primary_dataset.digest = new_digest
-                    job = Job.query.filter_by(data_container=dc).filter_by(task=u'find&proc').first()
-                    if not job:
-                        job = Job(data_container=dc, task=u'find&proc', status=u'pending', activity=u'pending')
-                        log.info(u'Created job %s' % job)
-                    elif job.status != u'pending' and not job.needs_rerun:
-                        job.needs_rerun = True
-                        log.info(u'Marked job  %s for restart' % job)
-                dc.scheduling = False
-                log.info(u'Done        %s' % dc)
+                    for filename in [f for f in os.listdir(dataset_path) if not f.startswith(arcdir)]:
+                        os.rename(os.path.join(dataset_path, filename), os.path.join(arcdir_path, filename))
+                    members = nimsutil.tar_directory(arcdir_path, '%s.tgz' % arcdir_path)
+                    manifest['%s.tgz' % arcdir] = nimsutil.manifest_entry('%s.tgz' % arcdir_path, members=members)
+                    shutil.rmtree(arcdir_path)
+                ds.filenames = os.listdir(dataset_path)
+                ds.manifest = json.dumps(manifest)
+                ds.compressed = True
                 transaction.commit()
-            else:
-                time.sleep(self.sleeptime)
+            elif ds.filetype == nimsdata.nimsraw.NIMSPFile.filetype:
+                # a .gz is complete, or left partial by a failed attempt and rewritten along with its file
+                for pfilepath in [os.path.join(dataset_path, f) for f in os.listdir(dataset_path) if not f.startswith('_') and not f.endswith('.gz')]:
+                    sha1 = nimsutil.gzip_inplace(pfilepath, 0o644)
+                    manifest[os.path.basename(pfilepath) + '.gz'] = nimsutil.manifest_entry(pfilepath + '.gz', sha1=sha1)
+                ds.filenames = os.listdir(dataset_path)
+                ds.manifest = json.dumps(manifest)
+                ds.compressed = True
+                transaction.commit()
+            DBSession.add(dc)
+
+    def schedule(self, dc):
+        new_job = False
+        log.info(u'Inspecting  %s' % dc)
+        ds = dc.primary_dataset
+        dataset_path = os.path.join(self.nims_path, ds.relpath)
+        manifest = nimsutil.update_manifest(dataset_path, json.loads(ds.manifest) if ds.manifest else None)
+        new_digest = nimsutil.manifest_digest(manifest)
+        if not ds.manifest and ds.digest and ds.digest == nimsutil.redigest(dataset_path):
+            ds.digest = new_digest  # unchanged since digested by a full redigest; switch to the manifest digest without a rerun
+        ds.manifest = json.dumps(manifest)
+        if dc.primary_dataset.digest != new_digest:
+            dc.primary_dataset.digest = new_digest
+            job = Job.query.filter_by(data_container=dc).filter_by(task=u'find&proc').first()
+            if not job:
+                job = Job(data_container=dc, task=u'find&proc', status=u'pending', activity=u'pending', priority=self.priority(dc))
+                new_job = True
+                log.info(u'Created job %s' % job)
+            elif job.status != u'pending' and not job.needs_rerun:
+                job.needs_rerun = True
+                log.info(u'Marked job  %s for restart' % job)
+        dc.scheduling = False
+        log.info(u'Done        %s' % dc)
+        transaction.commit()
+        if new_job:
+            self.notifier.notify('nims_job')
+
+    def priority(self, dc):
+        """Return the priority to queue the job of a data container with: scans fresh off the scanner take precedence over backfill and bulk reprocessing."""
+        return self.livepriority if dc.timestamp > datetime.datetime.now() - self.livetime else 0
 
     def reset_all(self):
         """Reset all scheduling data containers to dirty."""
@@ -115,7 +188,11 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('db_uri', help='database URI')
         self.add_argument('nims_path', help='data location')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
-        self.add_argument('-c', '--cooltime', type=int, default=30, help='time to let data cool before processing')
+        self.add_argument('-c', '--cooltime', type=int, default=30, help='time to let data cool before processing, unless the reaper marked it complete')
+        self.add_argument('-t', '--livetime', type=float, default=24, help='hours after acquisition that a scan counts as live (default: 24)')
+        self.add_argument('-p', '--livepriority', type=int, default=10, help='job priority of live scans, other scans get 0 (default: 10)')
+        self.add_argument('-w', '--workers', type=int, help='number of data containers to compress in parallel (default: number of cpus)')
+        self.add_argument('-N', '--notify', help='postgresql URI or socket directory to listen on for dirty data (default: database URI)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -124,7 +201,7 @@ class ArgumentParser(argparse.ArgumentParser):
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime)
+    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime, args.notify, args.livetime, args.livepriority, args.workers)
 
     def term_handler(signum, stack):
         scheduler.halt()
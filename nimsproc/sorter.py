@@ -4,13 +4,17 @@
 
 import os
 import glob
-import time
+import json
+import Queue
 import shutil
 import logging
 import tarfile
 import datetime
+import threading
 import transaction
+import multiprocessing.pool
 
+import nimsutil
 import nimsdata
 import nimsgears.model
 import tempdir as tempfile
@@ -31,30 +35,52 @@ def write_digest_file(path):
     digest_path = os.path.join(path, 'DIGEST.txt')
 
 
-def create_archive(path, content, arcname, **kwargs):
-    # write digest file
-    digest_filepath = os.path.join(content, 'DIGEST.txt')
-    open(digest_filepath, 'w').close() # touch file, so that it's included in the digest
-    filenames = sorted(os.listdir(content), key=lambda fn: (fn.endswith('.json') and 1) or (fn.endswith('.txt') and 2) or fn)
-    with open(digest_filepath, 'w') as digest_file:
-        digest_file.write('\n'.join(filenames) + '\n')
-    # create archive
-    with tarfile.open(path, 'w:gz', **kwargs) as archive:
-        archive.add(content, arcname, recursive=False) # add the top-level directory
-        for fn in filenames:
-            archive.add(os.path.join(content, fn), os.path.join(arcname, fn))
+class StagedFile(object):
+
+    """A staged file, parsed and ready to be sorted, with the temporary directory used to parse a pfile tgz."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.mrfile = None
+        self.tempdir = None
+
+    def cleanup(self):
+        if self.tempdir:
+            self.tempdir.cleanup()
 
 
 class Sorter(object):
 
-    def __init__(self, stage_path, preserve_path, nims_path, sleep_time):
+    """
+    Sort staged files into datasets.
+
+    Files are parsed by a pool of jobs threads, and then handed to one of jobs sort threads by series
+    UID, so that the files of a series are sorted in order while different series are sorted in
+    parallel. Looking up or creating the dataset of a file is serialized, since series of the same
+    session or subject may need the same new database entries.
+    """
+
+    def __init__(self, stage_path, preserve_path, nims_path, sleep_time, notifier=None, jobs=4):
         super(Sorter, self).__init__()
         self.stage_path = stage_path
         self.preserve_path = preserve_path
         self.nims_path = nims_path
         self.sleep_time = sleep_time
+        self.notifier = notifier or nimsutil.Notifier()
+        self.notifier.watch(self.stage_path)
+        self.jobs = jobs
         self.alive = True
 
+        self.parse_pool = multiprocessing.pool.ThreadPool(jobs)
+        self.catalog_lock = threading.Lock()
+        self.results = {}
+        self.errors = []
+        self.shards = [Queue.Queue() for i in range(jobs)]
+        for shard in self.shards:
+            worker = threading.Thread(target=self.sort_worker, args=(shard,))
+            worker.daemon = True
+            worker.start()
+
     def halt(self):
         self.alive = False
 
@@ -62,6 +88,8 @@ class Sorter(object):
         while self.alive:
             stage_items = [os.path.join(self.stage_path, si) for si in os.listdir(self.stage_path) if not si.startswith('.')] # ignore dot files
             if stage_items:
+                filepaths = []
+                stage_dirs = []
                 for stage_item in sorted(stage_items, key=os.path.getmtime): # oldest first
                     if os.path.islink(stage_item):
                         os.remove(stage_item)
@@ -76,15 +104,65 @@ class Sorter(object):
                         log.info('Done        %s' % os.path.basename(stage_item))
                         os.remove(stage_item)
                     elif os.path.isfile(stage_item):
-                        self.sort(stage_item)
+                        filepaths.append(stage_item)
                     else:
+                        stage_dirs.append(stage_item)
                         for subpath in [os.path.join(dirpath, fn) for (dirpath, _, filenames) in os.walk(stage_item) for fn in filenames]:
-                            if not os.path.islink(subpath) and not subpath.startswith('.'):
-                                self.sort(subpath)
-                        shutil.rmtree(stage_item)
+                            if not os.path.islink(subpath) and not subpath.startswith('.') and os.path.basename(subpath) != nimsutil.COMPLETE_MARKER:
+                                filepaths.append(subpath)
+                results = self.sort_all(filepaths)
+                for stage_dir in stage_dirs:
+                    expected = nimsutil.read_complete_marker(stage_dir)
+                    sorted_datasets = dict((os.path.relpath(fp, stage_dir), dataset_id) for fp, dataset_id in results.iteritems()
+                            if fp.startswith(stage_dir + os.sep) and dataset_id)
+                    if expected is not None and set(expected) <= set(sorted_datasets):
+                        self.mark_complete(set(sorted_datasets.itervalues()))
+                    shutil.rmtree(stage_dir)
+                self.notifier.notify('nims_dirty')
             else:
                 log.debug('Waiting for data...')
-                time.sleep(self.sleep_time)
+                self.notifier.wait(self.sleep_time)
+
+    def sort_all(self, filepaths):
+        """
+        Sort files in parallel, preserving the order of files of the same series, and return the dataset id of each file.
+
+        Files are handled in batches, to limit the number of pfiles extracted ahead of sorting. An error in a sort
+        thread is raised once its batch is done, leaving the remaining stage items in place.
+        """
+        self.results = {}
+        batch_size = 4 * self.jobs
+        for start in range(0, len(filepaths), batch_size):
+            for staged in self.parse_pool.imap(self.parse, filepaths[start:start+batch_size]):
+                if staged.mrfile:
+                    self.shards[hash(staged.mrfile.series_uid) % self.jobs].put(staged)
+                else:
+                    self.results[staged.filepath] = None
+            for shard in self.shards:
+                shard.join()
+            if self.errors:
+                raise self.errors.pop(0)
+        return self.results
+
+    def sort_worker(self, shard):
+        while True:
+            staged = shard.get()
+            try:
+                self.results[staged.filepath] = self.sort(staged)
+            except Exception as ex:
+                transaction.abort()
+                log.error('Failed to sort %s: %s' % (os.path.basename(staged.filepath), ex))
+                self.errors.append(ex)
+            finally:
+                staged.cleanup()
+                shard.task_done()
+
+    def mark_complete(self, dataset_ids):
+        """Mark datasets as complete, so that the scheduler does not wait for more data to arrive."""
+        for dataset in nimsgears.model.Dataset.query.filter(nimsgears.model.Dataset.id.in_(dataset_ids)).all():
+            dataset.complete = True
+            log.info('Complete    %s' % dataset.relpath)
+        transaction.commit()
 
     def preserve(self, filepath):
         if self.preserve_path:
@@ -92,90 +170,80 @@ class Sorter(object):
             log.debug('Preserving  %s' % os.path.basename(filepath))
             shutil.move(filepath, preserve_path)
 
-
-    def sort(self, filepath):
+    def parse(self, filepath):
         """
-        Revised sorter to handle multiple pfile acquisitions from a single series.
-        Expects tgz file to contain METADATA.json and DIGEST.txt as the first files
-        in the archive.
+        Parse a staged file, preserving it if it cannot be parsed.
+
+        Only the header of the pfile in a pfile tgz is extracted, into a temporary directory, which is kept
+        until the file is sorted.
         """
+        staged = StagedFile(filepath)
         filename = os.path.basename(filepath)
+        log.info('Parsing     %s' % filename)
         if 'pfile' in filename:
-            log.info('Parsing     %s' % filename)
-            with tempfile.TemporaryDirectory(dir=None) as tempdir_path:
-                with tarfile.open(filepath) as archive:
-                    archive.extractall(path=tempdir_path)
-                newdata_dir = os.path.join(tempdir_path, os.listdir(tempdir_path)[0])
-                try:
-                    new_digest = open(os.path.join(newdata_dir, 'DIGEST.txt')).read()
-                except IOError:
-                    log.debug('%s has no digest' % filepath)
-                    new_digest = None
-                pfile = glob.glob(os.path.join(newdata_dir, 'P?????.7'))[0]
-                try:
-                    mrfile = nimsdata.parse(pfile, filetype='pfile', full_parse=True)
-                except nimsdata.NIMSDataError:
-                    self.preserve(filepath)
-                else:
-                    log.info('Sorting     %s' % filename)
-                    filename = '_'.join(filename.rsplit('_')[-4:])
-                    dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
-                    existing_pf = glob.glob(os.path.join(self.nims_path, dataset.relpath, '*pfile.tgz'))
-                    if not existing_pf:
-                        shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-                    else:
-                        orig_pf = existing_pf[0]
-                        with tarfile.open(orig_pf) as orig_archive:
-                            for ti in orig_archive:
-                                if 'DIGEST.txt' in ti.name:
-                                    orig_digest = orig_archive.extractfile(ti).read()
-                                    break
-                            else:
-                                log.debug('no digest')
-                                orig_digest = None
-                        if (new_digest is None or orig_digest is None) or (new_digest != orig_digest):
-                            log.debug('repacking')
-                            with tempfile.TemporaryDirectory(dir=tempdir_path) as combined_dir:
-                                with tarfile.open(orig_pf) as orig_archive:
-                                    orig_archive.extractall(path=combined_dir)
-                                combineddata_dir = os.path.join(combined_dir, os.listdir(combined_dir)[0])
-                                for f in glob.glob(os.path.join(newdata_dir, '*')):
-                                    fn = os.path.basename(f)
-                                    log.debug('MOVING %s into %s' % (f, os.path.join(combineddata_dir, fn)))
-                                    shutil.move(f, os.path.join(combineddata_dir, fn))
-                                log.debug(os.listdir(combineddata_dir))
-                                outpath = os.path.join(tempdir_path, filename)
-                                create_archive(outpath, combineddata_dir, os.path.basename(combineddata_dir), compresslevel=6)
-                                shutil.move(outpath, os.path.join(self.nims_path, dataset.relpath, filename))
-                            os.remove(filepath)
-                        else:
-                            shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-
-                    log.debug('file sorted into to %s' % os.path.join(self.nims_path, dataset.relpath, filename))
-                    dataset.container.num_mux_cal_cycle = mrfile.num_mux_cal_cycle
-                    dataset.filenames = [filename]
-                    dataset.updatetime = datetime.datetime.now()
-                    dataset.untrash()
-                    transaction.commit()
+            staged.tempdir = tempfile.TemporaryDirectory(dir=None)
+            heads = nimsutil.extract_heads(filepath, staged.tempdir.name, ['P?????.7'], nimsutil.PFILE_HEADER_SIZE)
+            try:
+                staged.mrfile = nimsdata.parse(heads['P?????.7'], filetype='pfile', full_parse=True)
+            except nimsdata.NIMSDataError:
+                pass
         else:
             try:
-                mrfile = nimsdata.parse(filepath)
+                staged.mrfile = nimsdata.parse(filepath)
             except nimsdata.NIMSDataError:
-                self.preserve(filepath)
+                pass
             else:
-                mrfile.num_mux_cal_cycle = None  # dcms will never have num_mux_cal_cycles
-                if mrfile.is_screenshot:
-                    mrfile.acq_no = 0
-                    mrfile.timestamp = datetime.datetime.strptime(datetime.datetime.strftime(mrfile.timestamp, '%Y%m%d') + '235959', '%Y%m%d%H%M%S')
-                log.info('Sorting     %s' % filename)
-                filename = '_'.join(filename.rsplit('_')[-4:])
-                dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
-                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-                dataset.filenames = [filename]
-                dataset.updatetime = datetime.datetime.now()
-                dataset.untrash()
-                transaction.commit()
+                staged.mrfile.num_mux_cal_cycle = None  # dcms will never have num_mux_cal_cycles
+                if staged.mrfile.is_screenshot:
+                    staged.mrfile.acq_no = 0
+                    staged.mrfile.timestamp = datetime.datetime.strptime(datetime.datetime.strftime(staged.mrfile.timestamp, '%Y%m%d') + '235959', '%Y%m%d%H%M%S')
+        if not staged.mrfile:
+            self.preserve(filepath)
+            staged.cleanup()
+        return staged
+
+    def sort(self, staged):
+        """
+        Revised sorter to handle multiple pfile acquisitions from a single series.
+
+        Returns the id of the dataset the parsed file was sorted into.
+        """
+        filepath, mrfile = staged.filepath, staged.mrfile
+        filename = os.path.basename(filepath)
+        log.info('Sorting     %s' % filename)
+        filename = '_'.join(filename.rsplit('_')[-4:])
+        with self.catalog_lock:
+            dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
+            transaction.commit()    # new catalog entries must be visible to the other sort threads once the lock is released
+            nimsgears.model.DBSession.add(dataset)
+        dataset_path = os.path.join(self.nims_path, dataset.relpath)
+        if staged.tempdir:
+            # acquisitions are appended to the dataset directory; a legacy pfile archive is unpacked into it once
+            digests = json.loads(dataset.member_digests) if dataset.member_digests else {}
+            manifest = json.loads(dataset.manifest) if dataset.manifest else {}
+            for legacy_pf in glob.glob(os.path.join(dataset_path, '*pfile.tgz')):
+                log.debug('unpacking legacy archive %s' % os.path.basename(legacy_pf))
+                digests, manifest = nimsutil.append_archive(legacy_pf, dataset_path, digests, manifest)
+                os.remove(legacy_pf)
+            new_digests, manifest = nimsutil.append_archive(filepath, dataset_path, digests, manifest)
+            log.debug('appended %s' % (', '.join(sorted(fn for fn in new_digests if new_digests[fn] != digests.get(fn))) or 'nothing new'))
+            dataset.member_digests = unicode(json.dumps(new_digests, sort_keys=True))
+            dataset.manifest = json.dumps(manifest)     # the scheduler only needs to digest what the sorter did not write
+            os.remove(filepath)
+            log.debug('file sorted into %s' % dataset_path)
+            dataset.container.num_mux_cal_cycle = mrfile.num_mux_cal_cycle
+            dataset.filenames = sorted(f for f in os.listdir(dataset_path) if not f.startswith('.'))
+            dataset.compressed = True
+        else:
+            shutil.move(filepath, os.path.join(dataset_path, filename))
+            dataset.filenames = [filename]
+        dataset.updatetime = datetime.datetime.now()
+        dataset.complete = False
+        dataset.untrash()
+        dataset_id = dataset.id
+        transaction.commit()
         log.info('Done        %s' % filename)
+        return dataset_id
 
 
 if __name__ == '__main__':
@@ -183,15 +251,15 @@ if __name__ == '__main__':
     import argparse
     import sqlalchemy
 
-    import nimsutil
-
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('db_uri', help='database URI')
     arg_parser.add_argument('stage_path', help='path to staging area')
     arg_parser.add_argument('nims_path', help='data destination')
     arg_parser.add_argument('-t', '--toplevel', action='store_true', help='handle toplevel files')
     arg_parser.add_argument('-p', '--preserve_path', help='preserve unsortable files here')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=4, help='number of files to parse, and series to sort, in parallel (default: 4)')
     arg_parser.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep before checking for new files')
+    arg_parser.add_argument('-N', '--notify', help='postgresql URI or socket directory to listen on for staged data (default: database URI)')
     arg_parser.add_argument('-f', '--logfile', help='path to log file')
     arg_parser.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
     arg_parser.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -199,7 +267,8 @@ if __name__ == '__main__':
 
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
     nimsgears.model.init_model(sqlalchemy.create_engine(args.db_uri))
-    sorter = Sorter(args.stage_path, args.preserve_path, args.nims_path, args.sleeptime)
+    notifier = nimsutil.Notifier.from_uri(args.notify or args.db_uri, 'nims_stage')
+    sorter = Sorter(args.stage_path, args.preserve_path, args.nims_path, args.sleeptime, notifier, args.jobs)
 
     def term_handler(signum, stack):
         sorter.halt()
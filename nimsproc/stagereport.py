@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""Report the time spent in each stage of recent processing jobs."""
+
+import argparse
+import datetime
+import numpy as np
+
+import sqlalchemy
+
+import nimsutil
+from nimsgears.model import *
+
+
+def stage_report(since, groupby='psd'):
+    """Return (group, stage, count, wall p50, wall p95, cpu p50, cpu p95, bytes p50) tuples for stages since a datetime."""
+    group_column = getattr(Epoch, groupby)
+    rows = (DBSession.query(group_column, JobStage.stage, JobStage.wall_time, JobStage.cpu_time, JobStage.bytes_written)
+            .join(Job, JobStage.job)
+            .join(Epoch, Job.data_container)
+            .filter(JobStage.started > since)
+            .all())
+    stage_dict = {}
+    for group, stage, wall_time, cpu_time, bytes_written in rows:
+        stage_dict.setdefault((group or u'unknown', stage), []).append((wall_time, cpu_time, bytes_written or 0))
+    report = []
+    for (group, stage), values in sorted(stage_dict.iteritems()):
+        wall, cpu, bytes_ = (np.array(v, dtype=float) for v in zip(*values))
+        report.append((group, stage, len(values),
+                np.percentile(wall, 50), np.percentile(wall, 95),
+                np.percentile(cpu, 50), np.percentile(cpu, 95),
+                np.percentile(bytes_, 50)))
+    return report
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.add_argument('db_uri', help='database URI')
+        self.add_argument('-d', '--days', type=float, default=7, help='report on jobs of the last DAYS days (default: 7)')
+        self.add_argument('-g', '--groupby', choices=['psd', 'scan_type'], default='psd', help='group stages by psd or scan type (default: psd)')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    init_model(sqlalchemy.create_engine(args.db_uri))
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+
+    print '%-24s %-8s %6s %9s %9s %9s %9s %7s' % (args.groupby, 'stage', 'count', 'wall p50', 'wall p95', 'cpu p50', 'cpu p95', 'written')
+    for group, stage, count, wall50, wall95, cpu50, cpu95, bytes50 in stage_report(since, args.groupby):
+        print '%-24.24s %-8s %6d %8.1fs %8.1fs %8.1fs %8.1fs %7s' % (group, stage, count, wall50, wall95, cpu50, cpu95, nimsutil.hrsize(bytes50))
@@ -6,15 +6,37 @@
 import os
 import re
 import gzip
+import json
+import time
+import zlib
+import struct
+import errno
+import fcntl
 import shutil
+import select
+import socket
 import string
+import ctypes
+import fnmatch
 import tarfile
 import difflib
 import hashlib
 import datetime
 import tempfile
+import threading
+import subprocess
+import collections
+import ctypes.util
+import distutils.spawn
+import multiprocessing
+import multiprocessing.pool
 import logging, logging.handlers
 
+log = logging.getLogger('nimsutil')
+
+COMPLETE_MARKER = 'SERIES_COMPLETE.json'
+PFILE_HEADER_SIZE = 262144    # larger than the header of any pfile revision
+
 
 class TempDir(object):
 
@@ -34,6 +56,405 @@ class TempDir(object):
         shutil.rmtree(self.temp_dir)
 
 
+class Notifier(object):
+
+    """
+    Wake up a consumer as soon as new work is announced on one of its channels.
+
+    This base class does not listen on anything; wait() simply sleeps for the given time. It is
+    the polling fallback, and the subclasses keep polling semantics by returning after timeout
+    seconds, even if no notification has arrived.
+
+    Any notifier can also watch directories, to wake up as soon as a file is written into, or moved
+    into, one of them. Such events are returned as (path of the directory, filename) tuples.
+    """
+
+    def __init__(self, *channels):
+        self.channels = channels
+        self.watchers = []
+
+    @classmethod
+    def from_uri(cls, uri, *channels):
+        """Return a notifier for a postgresql:// URI or a socket directory, or a polling notifier."""
+        if uri and uri.startswith('postgres'):
+            return PGNotifier(uri, *channels)
+        elif uri and os.path.isdir(uri):
+            return SocketNotifier(uri, *channels)
+        return cls(*channels)
+
+    def notify(self, channel, payload=''):
+        pass
+
+    def watch(self, path, patterns=None):
+        """Also wake up on files matching patterns written into, or moved into, path, if the platform supports it."""
+        watcher = DirectoryWatcher(path, patterns)
+        if watcher.fd is not None:
+            self.watchers.append(watcher)
+
+    def watched(self, readable):
+        """Return the (path, filename) tuples of the watchers among readable."""
+        return [(watcher.path, name) for watcher in self.watchers if watcher in readable for name in watcher.read()]
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds, returning a list of received (channel, payload) tuples."""
+        if not self.watchers:
+            time.sleep(timeout)
+            return []
+        return self.watched(select.select(self.watchers, [], [], timeout)[0])
+
+    def close(self):
+        for watcher in self.watchers:
+            watcher.close()
+        self.watchers = []
+
+
+class PGNotifier(Notifier):
+
+    """
+    Notifier based on PostgreSQL LISTEN/NOTIFY.
+
+    wait() listens on its own connection, and is meant to be called by one thread. notify() may be
+    called from any thread, and shares a second connection, so that a failed notify never closes the
+    connection that wait() is using.
+    """
+
+    def __init__(self, db_uri, *channels):
+        super(PGNotifier, self).__init__(*channels)
+        self.db_uri = db_uri
+        self.conn = None
+        self.notify_conn = None
+        self.notify_lock = threading.Lock()
+
+    def connect(self, channels=()):
+        import psycopg2, psycopg2.extensions
+        from sqlalchemy.engine.url import make_url
+        url = make_url(self.db_uri)
+        conn = psycopg2.connect(**dict(url.translate_connect_args(username='user'), **url.query))
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        for channel in channels:
+            cursor.execute('LISTEN %s' % channel)
+        return conn
+
+    def notify(self, channel, payload=''):
+        with self.notify_lock:
+            try:
+                if not self.notify_conn: self.notify_conn = self.connect()
+                self.notify_conn.cursor().execute('SELECT pg_notify(%s, %s)', (channel, payload))
+            except Exception as ex:
+                log.warning('cannot notify %s: %s' % (channel, ex))
+                self.notify_conn = self.disconnect(self.notify_conn)
+
+    def wait(self, timeout):
+        try:
+            if not self.conn: self.conn = self.connect(self.channels)
+            readable = select.select([self.conn] + self.watchers, [], [], 0 if self.conn.notifies else timeout)[0]
+            if self.conn in readable:
+                self.conn.poll()
+        except Exception as ex:
+            log.warning('cannot listen for %s: %s' % (', '.join(self.channels), ex))
+            self.conn = self.disconnect(self.conn)
+            return super(PGNotifier, self).wait(timeout)
+        notifications = [(n.channel, n.payload) for n in self.conn.notifies]
+        del self.conn.notifies[:]
+        return notifications + self.watched(readable)
+
+    def disconnect(self, conn):
+        """Close conn, ignoring errors, and return None."""
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.conn = self.disconnect(self.conn)
+        with self.notify_lock:
+            self.notify_conn = self.disconnect(self.notify_conn)
+        super(PGNotifier, self).close()
+
+
+class SocketNotifier(Notifier):
+
+    """
+    Notifier based on Unix datagram sockets, one per channel, in a shared directory.
+
+    Useful on a single host, and in tests, where no PostgreSQL server is available. Each channel
+    has at most one listener; notifications to a channel without a listener are dropped.
+    """
+
+    def __init__(self, path, *channels):
+        super(SocketNotifier, self).__init__(*channels)
+        self.path = path
+        self.socks = []
+        for channel in channels:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock_path = os.path.join(path, channel)
+            if os.path.exists(sock_path):
+                os.remove(sock_path)
+            sock.bind(sock_path)
+            self.socks.append((channel, sock))
+
+    def notify(self, channel, payload=''):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.sendto(payload, os.path.join(self.path, channel))
+        except socket.error as ex:
+            if ex.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+                raise
+        finally:
+            sock.close()
+
+    def wait(self, timeout):
+        if not self.socks:
+            return super(SocketNotifier, self).wait(timeout)
+        readable = select.select([sock for channel, sock in self.socks] + self.watchers, [], [], timeout)[0]
+        return [(channel, sock.recv(4096)) for channel, sock in self.socks if sock in readable] + self.watched(readable)
+
+    def close(self):
+        for channel, sock in self.socks:
+            sock.close()
+            os.remove(os.path.join(self.path, channel))
+        self.socks = []
+        super(SocketNotifier, self).close()
+
+
+class DirectoryWatcher(object):
+
+    """
+    Report files closed after writing in, or moved into, a directory, using Linux inotify.
+
+    Hidden files, and files not matching any of patterns, are ignored. If inotify is not available,
+    fd is None, and the caller has to fall back to polling. inotify only sees changes made through
+    this host's kernel, so files written into an NFS mount by another host are never reported.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path, patterns=None):
+        self.path = path
+        self.patterns = patterns
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(fd, path, self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as ex:
+            log.info('cannot watch %s, polling instead: %s' % (path, ex))
+        else:
+            self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return the names of the files reported since the last read, without blocking."""
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset+16:offset+16+length].rstrip('\0')
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    log.warning('missed events in %s' % self.path)
+                elif not name.startswith('.') and (not self.patterns or any(fnmatch.fnmatch(name, p) for p in self.patterns)):
+                    names.append(name)
+        return names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SlotPool(object):
+
+    """
+    A pool of slots shared by all threads and processes on a host.
+
+    Each slot is a lock file in a common directory. A held slot is an flock()ed file, so slots
+    are released automatically when their holder exits, even after a crash.
+    """
+
+    def __init__(self, path, size):
+        self.path = make_joined_path(path)
+        self.size = size
+
+    def acquire(self, max_slots, wait=1):
+        """Block until at least one slot is free, then take up to max_slots free slots."""
+        while True:
+            fds = []
+            for i in range(self.size):
+                if len(fds) == max_slots:
+                    break
+                fd = os.open(os.path.join(self.path, 'slot%03d' % i), os.O_CREAT | os.O_RDWR, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    os.close(fd)
+                else:
+                    fds.append(fd)
+            if fds:
+                return SlotLease(fds)
+            time.sleep(wait)
+
+
+class SlotLease(object):
+
+    """Context managed set of slots taken from a SlotPool, returning the number of slots on entry."""
+
+    def __init__(self, fds):
+        self.fds = fds
+
+    def __len__(self):
+        return len(self.fds)
+
+    def __enter__(self):
+        return len(self.fds)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class TarStream(object):
+
+    """
+    Context managed background extraction of a gzipped tar archive.
+
+    Members are streamed to disk one by one, decompressed by pigz if it is available, so that callers
+    can start using a member as soon as it, or just its first bytes, have been written. Extraction is
+    aborted on context exit.
+    """
+
+    chunk_size = 1048576
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.written = []       # (path, bytes written, complete) per member, in archive order
+        self.finished = False
+        self.aborted = False
+        self.error = None
+        self.proc = None
+        self.thread = None
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def extract(self, path):
+        """Start extracting the archive at path."""
+        pigz = distutils.spawn.find_executable('pigz')
+        if pigz:
+            self.proc = subprocess.Popen([pigz, '-dc', path], stdout=subprocess.PIPE)
+            archive = tarfile.open(fileobj=self.proc.stdout, mode='r|')
+        else:
+            archive = tarfile.open(path, mode='r|gz')
+        self.thread = threading.Thread(target=self.run, args=(archive,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, archive):
+        try:
+            for member in archive:
+                if self.aborted:
+                    break
+                if not member.isfile():
+                    archive.extract(member, self.dest_dir)
+                    continue
+                path = os.path.join(self.dest_dir, member.name)
+                make_joined_path(os.path.dirname(path))
+                with self.cond:
+                    self.written.append([path, 0, False])
+                    entry = self.written[-1]
+                fileobj = archive.extractfile(member)
+                with open(path, 'wb') as fd:
+                    for chunk in iter(lambda: fileobj.read(self.chunk_size), ''):
+                        if self.aborted:
+                            break
+                        fd.write(chunk)
+                        fd.flush()
+                        with self.cond:
+                            entry[1] += len(chunk)
+                            self.cond.notify_all()
+                os.chmod(path, member.mode)
+                with self.cond:
+                    entry[2] = not self.aborted
+                    self.cond.notify_all()
+                if self.aborted:
+                    break   # before the next member, which would first skip through the rest of this one
+        except Exception as ex:
+            if not self.aborted:
+                self.error = ex
+        finally:
+            archive.close()
+            if self.proc:
+                if self.aborted:
+                    self.proc.kill()
+                self.proc.stdout.close()
+                if self.proc.wait() and not self.aborted and not self.error:
+                    self.error = IOError('pigz failed with exit status %d' % self.proc.returncode)
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def wait_for(self, pattern, nbytes=None):
+        """
+        Return the path of the first member whose name matches pattern.
+
+        Blocks until the member is completely extracted or, if nbytes is given, until its first nbytes are on disk.
+        """
+        with self.cond:
+            while True:
+                for path, written, complete in self.written:
+                    if fnmatch.fnmatch(os.path.basename(path), pattern) and (complete or (nbytes and written >= nbytes)):
+                        return path
+                if self.finished:
+                    raise self.error or IOError('no member matching %s in archive' % pattern)
+                self.cond.wait(1)
+
+    def join(self):
+        """Wait for extraction to finish, raising any error that occurred."""
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """Abort extraction, killing pigz so that no more of the archive is decompressed, and wait for the thread to exit."""
+        if self.thread:
+            self.aborted = True
+            if self.proc:
+                try:
+                    self.proc.kill()
+                except OSError:
+                    pass    # already exited
+            self.thread.join()
+            self.thread = None
+
+
 def configure_log(filepath=None, console=True, level='debug'):
     """Return a nims-configured logger."""
     logging._levelNames[10] = 'DBUG'
@@ -208,14 +629,231 @@ def hrsize(size):
     return '%.0f%s' % (size, 'Y')
 
 
+def publish(path, dst_dir):
+    """
+    Move a file or directory into dst_dir, such that readers never see it partially written.
+
+    Within one filesystem, this is a single rename. Across filesystems, it is copied under a hidden
+    name in dst_dir first, and then renamed into place.
+    """
+    dst_path = os.path.join(dst_dir, os.path.basename(path))
+    try:
+        os.rename(path, dst_path)
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        partial_path = os.path.join(dst_dir, '.%s.partial' % os.path.basename(path))
+        if os.path.isdir(path):
+            shutil.copytree(path, partial_path)
+            os.rename(partial_path, dst_path)
+            shutil.rmtree(path)
+        else:
+            shutil.copy2(path, partial_path)
+            os.rename(partial_path, dst_path)
+            os.remove(path)
+    return dst_path
+
+
+def extract_heads(path, dest_dir, patterns, nbytes):
+    """
+    Extract the first nbytes of the first member of a tar archive matching each of patterns into dest_dir.
+
+    The archive is streamed, and only decompressed up to the last member needed. Return a dictionary of
+    the patterns found and the paths of their extracted heads.
+    """
+    heads = {}
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            for pattern in [p for p in patterns if p not in heads and fnmatch.fnmatch(name, p)]:
+                heads[pattern] = os.path.join(dest_dir, name)
+                with open(heads[pattern], 'wb') as fd:
+                    fd.write(archive.extractfile(member).read(nbytes))
+                break
+            if len(heads) == len(patterns):
+                break
+    return heads
+
+
+def append_archive(tgz_path, path, digests=None, manifest=None, gzip_patterns=('P?????.7',)):
+    """
+    Append the file members of a tar archive to a directory, returning the digests and the manifest of all files appended so far.
+
+    Each member is stored as an individual file, gzipped if its name matches one of gzip_patterns, and
+    replaces any file of the same name. The digest of a member is its size and mtime, from its tar header.
+    A member whose digest matches that in digests, the dictionary returned by a previous append, is skipped
+    without being extracted, so that resending an archive costs no more than reading it. The DIGEST.txt
+    of the directory lists the union of the files appended so far, so that adding an archive never
+    rewrites the files already in the directory.
+
+    Files are hashed as they are written, and their entries replaced in manifest, as update_manifest
+    would write them, so that the directory never needs to be read back to be digested.
+    """
+    digests = dict(digests or {})
+    manifest = dict(manifest or {})
+
+    def store(stored_name, write, mtime):
+        partial_path = os.path.join(path, '.%s.partial' % stored_name)
+        with open(partial_path, 'wb') as fd:
+            hashing_fd = HashingFile(fd)
+            write(hashing_fd)
+        os.chmod(partial_path, 0o644)
+        os.utime(partial_path, (mtime, mtime))
+        os.rename(partial_path, os.path.join(path, stored_name))
+        manifest[stored_name] = manifest_entry(os.path.join(path, stored_name), sha1=hashing_fd.hexdigest())
+
+    with tarfile.open(tgz_path, 'r|*') as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name == 'DIGEST.txt':
+                continue
+            gzipped = any(fnmatch.fnmatch(name, p) for p in gzip_patterns)
+            stored_name = name + '.gz' if gzipped else name
+            digest = [member.size, int(member.mtime)]
+            if digests.get(stored_name) == digest and os.path.exists(os.path.join(path, stored_name)):
+                continue
+            fileobj = archive.extractfile(member)
+            if gzipped:
+                store(stored_name, lambda fd: gzip_parallel(fileobj, fd, name, member.mtime), member.mtime)
+            else:
+                store(stored_name, lambda fd: shutil.copyfileobj(fileobj, fd), member.mtime)
+            digests[stored_name] = digest
+    listing = '\n'.join(sorted(set(digests) | set(['DIGEST.txt']))) + '\n'
+    store('DIGEST.txt', lambda fd: fd.write(listing), time.time())
+    manifest = dict((fn, entry) for fn, entry in manifest.iteritems() if os.path.exists(os.path.join(path, fn)))
+    return digests, manifest
+
+
+def write_complete_marker(path, filenames):
+    """Mark a staged directory as a complete series, that the sorter should find filenames in."""
+    with open(os.path.join(path, COMPLETE_MARKER), 'w') as marker_file:
+        json.dump({'files': sorted(filenames)}, marker_file)
+        marker_file.write('\n')
+
+
+def read_complete_marker(path):
+    """Return the filenames expected in a staged directory marked as a complete series, or None if not marked."""
+    try:
+        with open(os.path.join(path, COMPLETE_MARKER)) as marker_file:
+            return json.load(marker_file)['files']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def disk_usage(path):
+    """Return the total size of a file, or of all files in a directory tree."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, fn)) for dirpath, _, filenames in os.walk(path) for fn in filenames)
+
+
+class HashingFile(object):
+
+    """File object wrapper that computes the sha1 of all data read from or written to it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def write(self, data):
+        self.hash.update(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def gzip_parallel(src, dst, filename='', mtime=0, compresslevel=4, threads=None, block_size=1048576):
+    """
+    Write a gzip stream of the file object src into the file object dst, compressing blocks in parallel.
+
+    Like pigz, each block of block_size bytes is compressed independently, on a pool of threads, and
+    sync-flushed to a byte boundary, so that the compressed blocks concatenate into a single deflate
+    stream. zlib releases the GIL while compressing. At most two blocks per thread are held in memory.
+    The output is a standard single-member .gz file, at most a few bytes per block larger than that
+    of gzip.
+    """
+
+    def compress(block, last):
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    threads = threads or multiprocessing.cpu_count()
+    dst.write('\x1f\x8b\x08' + ('\x08' if filename else '\x00') + struct.pack('<I', int(mtime)) + '\x00\xff')
+    if filename:
+        dst.write(filename + '\x00')
+    crc, size = 0, 0
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        pending = collections.deque()
+        block = src.read(block_size)
+        while True:
+            next_block = src.read(block_size)
+            pending.append(pool.apply_async(compress, (block, not next_block)))
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            if not next_block:
+                break
+            block = next_block
+            if len(pending) >= 2 * threads:
+                dst.write(pending.popleft().get())
+        while pending:
+            dst.write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    dst.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+
+
 def gzip_inplace(path, mode=None):
+    """Replace a file by its gzipped version, returning the sha1 of the gzipped file."""
     gzpath = path + '.gz'
-    with gzip.open(gzpath, 'wb', compresslevel=4) as gzfile:
-        with open(path) as pathfile:
-            gzfile.writelines(pathfile)
+    with open(gzpath, 'wb') as fd:
+        hashing_fd = HashingFile(fd)
+        with open(path, 'rb') as pathfile:
+            gzip_parallel(pathfile, hashing_fd, os.path.basename(path), os.path.getmtime(path))
     shutil.copystat(path, gzpath)
     if mode: os.chmod(gzpath, mode)
     os.remove(path)
+    return hashing_fd.hexdigest()
+
+
+def tar_directory(path, tgz_path, compresslevel=6):
+    """Write a directory tree into a gzipped tar archive, returning the names and sha1s of its file members."""
+    members = []
+    with tarfile.open(tgz_path, 'w:gz', compresslevel=compresslevel) as archive:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            arcdir = os.path.relpath(dirpath, os.path.dirname(path))
+            archive.addfile(archive.gettarinfo(dirpath, arcdir))
+            for filename in sorted(filenames):
+                tarinfo = archive.gettarinfo(os.path.join(dirpath, filename), os.path.join(arcdir, filename))
+                with open(os.path.join(dirpath, filename), 'rb') as fd:
+                    hashing_fd = HashingFile(fd)
+                    archive.addfile(tarinfo, hashing_fd)
+                members.append((tarinfo.name, hashing_fd.hexdigest()))
+    return members
+
+
+def manifest_entry(filepath, sha1=None, members=None):
+    """Return the manifest entry of a file, with its sha1 or, for a tar archive, the names and sha1s of its file members."""
+    stat = os.stat(filepath)
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'inode': stat.st_ino}
+    if members is not None:
+        entry['members'] = members
+    else:
+        entry['sha1'] = sha1
+    return entry
 
 
 def redigest(path):
@@ -237,3 +875,46 @@ def redigest(path):
             with open(filepath, 'rb') as fd:
                 hash_file(fd)
     return hash_.digest()
+
+
+def update_manifest(path, manifest=None):
+    """
+    Return a manifest of the files in path, re-hashing only files that are new or changed since manifest.
+
+    The manifest maps each file name to its size, mtime and inode, and to its sha1 or, for tar archives,
+    the names and sha1s of its file members. A file is considered unchanged if its size, mtime and inode are.
+    """
+
+    def hash_file(fd):
+        hash_ = hashlib.sha1()
+        for chunk in iter(lambda: fd.read(1048576 * hash_.block_size), ''):
+            hash_.update(chunk)
+        return hash_.hexdigest()
+
+    manifest = manifest or {}
+    new_manifest = {}
+    for filename in os.listdir(path):
+        filepath = os.path.join(path, filename)
+        stat = os.stat(filepath)
+        entry = manifest.get(filename)
+        if entry and (entry['size'], entry['mtime'], entry['inode']) == (stat.st_size, stat.st_mtime, stat.st_ino):
+            new_manifest[filename] = entry
+            continue
+        if tarfile.is_tarfile(filepath):
+            with tarfile.open(filepath, 'r:*') as archive:
+                members = [(member.name, hash_file(archive.extractfile(member))) for member in archive if member.isfile()]
+            new_manifest[filename] = manifest_entry(filepath, members=members)
+        else:
+            with open(filepath, 'rb') as fd:
+                new_manifest[filename] = manifest_entry(filepath, sha1=hash_file(fd))
+    return new_manifest
+
+
+def manifest_digest(manifest):
+    """Return the digest of the contents listed in a manifest, which does not change when files are re-archived."""
+    hash_ = hashlib.sha1()
+    for filename in sorted(manifest):
+        entry = manifest[filename]
+        for sha1 in ([sha1 for _, sha1 in entry['members']] if 'members' in entry else [entry['sha1']]):
+            hash_.update(sha1)
+    return hash_.digest()